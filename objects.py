@@ -1,11 +1,23 @@
 import threading
+import os
+import asyncio
 import math
 import struct
 import time
 import selectors
+import socket
+import errno
+import queue
 import utils
 import traceback
-from collections import deque
+import bisect
+import random
+import hashlib
+import concurrent.futures
+import functools
+from array import array
+from collections import deque, OrderedDict
+from bitstring import BitArray
 
 # This variable is used for toggling console debug messages
 # Enabled means you can view object states and connections in the console
@@ -21,6 +33,77 @@ REQUEST = 6
 PIECE = 7
 CANCEL = 8
 PORT = 9
+# BEP 6 Fast Extension
+SUGGEST_PIECE = 13
+HAVE_ALL = 14
+HAVE_NONE = 15
+REJECT_REQUEST = 16
+ALLOWED_FAST = 17
+# BEP 10 Extension Protocol: payload starts with the extended message id (0 = extended handshake)
+EXTENDED = 20
+EXTENDED_HANDSHAKE = 0
+# Our extended message id for ut_pex (BEP 11), announced in the extended handshake
+UT_PEX_ID = 1
+
+# Reserved handshake bit for the Fast Extension (reserved[7] & 0x04)
+FAST_EXTENSION_BIT = 0x04
+# Size of the allowed fast set we hand out to peers we're choking
+ALLOWED_FAST_COUNT = 10
+# Reserved handshake bit for the Extension Protocol (reserved[5] & 0x10)
+EXTENSION_PROTOCOL_BIT = 0x10
+# Seconds between PEX messages to a peer, and most addresses added/dropped in one of them
+PEX_INTERVAL = 60
+MAX_PEX_PEERS = 50
+
+# Largest length prefix we accept from a peer. A PIECE is 9 + 16KB and even the bitfield of a huge
+# torrent is far below this, so anything bigger is a broken (or malicious) peer
+MAX_MESSAGE_LENGTH = 2**20
+# Starting size of each connection's receive buffer (grows only if a single message needs more room)
+RECV_BUFFER_SIZE = 2**16
+# Most buffers handed to a single sendmsg call
+MAX_IOV = 64
+
+# Standard block size for requests (16KB)
+BLOCK_SIZE = 2**14
+# Bounds for the adaptive request pipeline (outstanding requests per peer)
+MIN_PIPELINE = 2
+MAX_PIPELINE = 250
+# How often a peer's download rate is sampled, and how long its minimum RTT is remembered (seconds)
+RATE_SAMPLE_INTERVAL = 1
+MIN_RTT_WINDOW = 10
+
+# Selector engine timings (seconds)
+ENGINE_TICK = 1
+CONNECT_TIMEOUT = 3
+HANDSHAKE_TIMEOUT = 10
+KEEP_ALIVE_INTERVAL = 120
+PEER_TIMEOUT = 120
+
+# Most waiting pieces a pick tries before going through the peer's own pieces instead (see piecePicker)
+PICK_SCAN_LIMIT = 256
+
+# Outbound connects/handshakes in flight at once
+MAX_CONCURRENT_DIALS = 32
+
+# A request is given up on (and its block requested elsewhere) after REQUEST_TIMEOUT seconds, or
+# REQUEST_TIMEOUT_RTTS smoothed RTTs if that's longer. A peer that sends no block for SNUB_TIMEOUT
+# seconds while we wait on it is snubbed (see peer.check_requests)
+REQUEST_TIMEOUT = 15
+REQUEST_TIMEOUT_RTTS = 4
+SNUB_TIMEOUT = 60
+
+# Most output files kept open at once (multi-file torrents can have hundreds of thousands)
+MAX_OPEN_FILES = 256
+
+# Seconds between saves of the fast-resume file (it's also saved on shutdown)
+RESUME_INTERVAL = 30
+# Bytes of consecutive pieces a recheck process reads and hashes at a time
+RECHECK_CHUNK = 16 * 2**20
+
+# Streaming ('-s'): bytes past the read position the picker downloads first, and most bytes
+# written to the stream at a time
+STREAM_WINDOW = 32 * 2**20
+STREAM_CHUNK = 4 * 2**20
 
 class handshake:
     def __init__(self):
@@ -56,7 +139,10 @@ class handshake:
         value1, value2 = value
         self._pstrlen = len("BitTorrent protocol").to_bytes(1,byteorder='big')
         self._pstr = "BitTorrent protocol".encode('utf-8')
-        self._reserved = b'\x00\x00\x00\x00\x00\x00\x00\x00'
+        reserved = bytearray(8)
+        reserved[5] |= EXTENSION_PROTOCOL_BIT
+        reserved[7] |= FAST_EXTENSION_BIT
+        self._reserved = bytes(reserved)
         self._info_hash = value1
         self._peer_id = value2
 
@@ -74,6 +160,14 @@ class handshake:
 # len 0009 + x,id = 7 -> piece: payload is of form <index><begin><block>, all integers, index-> zero-based piece index, begin-> zero based byte offset in the piece, block-> block of data, subset of piece (index)
 # len 0013,id = 8 -> cancel: cancel block requests
 # len 0003,id = 9 -> port: 
+# Fast Extension (BEP 6, only if both handshakes set reserved[7] & 0x04):
+# len 0005,id = 13 -> suggest piece: payload is a piece index
+# len 0001,id = 14 -> have all (replaces the bitfield of a seeder)
+# len 0001,id = 15 -> have none (replaces an empty bitfield)
+# len 0013,id = 16 -> reject request: payload is <index><begin><length> of a request that won't be answered
+# len 0005,id = 17 -> allowed fast: payload is a piece index that can be requested while choked
+# Extension Protocol (BEP 10, only if both handshakes set reserved[5] & 0x10):
+# len 0002 + x,id = 20 -> extended: payload is <extended msg id><bencoded dictionary>
 # payload - msg dependent
 class messages:
     def __init__(self):
@@ -81,6 +175,8 @@ class messages:
         self._msgid: None
         self._payload: None
         self._fullMessage = None
+        self._fileSegment = None
+        self._block = None
     @property
     def lenprefix(self):
         return self._lenprefix
@@ -93,6 +189,14 @@ class messages:
     @property
     def fullMessage(self):
         return self._fullMessage
+    # (file object, offset, length) of block data that goes on the wire right after fullMessage
+    @property
+    def fileSegment(self):
+        return self._fileSegment
+    # Buffer (memoryview) of block data that goes on the wire right after fullMessage
+    @property
+    def block(self):
+        return self._block
     
     def keepAlive(self):
         self._lenprefix = b'\x00\x00\x00\x00'
@@ -124,6 +228,12 @@ class messages:
         self._payload = b''
         self._fullMessage = (self._lenprefix + self._msgid + self._payload)
 
+    def bitfield(self, value):
+        self._lenprefix = struct.pack(">I", 1 + len(value))
+        self._msgid = b'\x05'
+        self._payload = value
+        self._fullMessage = (self._lenprefix + self._msgid + self._payload)
+
     def have(self,value):
         self._lenprefix = b'\x00\x00\x00\x05'
         self._msgid = b'\x04'
@@ -137,13 +247,1137 @@ class messages:
         self._payload = struct.pack(">III", index, begin, length)
         self._fullMessage = (self._lenprefix + self._msgid + self._payload)
 
+    def cancel(self, value):
+        index, begin, length = value
+        self._lenprefix = struct.pack(">I", 13)
+        self._msgid = b'\x08'
+        self._payload = struct.pack(">III", index, begin, length)
+        self._fullMessage = (self._lenprefix + self._msgid + self._payload)
+
     def piece(self, value):
         length, index, begin, block = value 
         self._lenprefix = struct.pack(">I", 9+length)
         self._msgid = b'\x07'
-        self._payload = struct.pack(f">II{length}B", index, begin, block)
+        self._payload = struct.pack(">II", index, begin) + bytes(block)
+        self._fullMessage = (self._lenprefix + self._msgid + self._payload)
+
+    def suggestPiece(self, value):
+        self._lenprefix = b'\x00\x00\x00\x05'
+        self._msgid = b'\x0d'
+        self._payload = struct.pack(">I", value)
+        self._fullMessage = (self._lenprefix + self._msgid + self._payload)
+
+    def haveAll(self):
+        self._lenprefix = b'\x00\x00\x00\x01'
+        self._msgid = b'\x0e'
+        self._payload = b''
         self._fullMessage = (self._lenprefix + self._msgid + self._payload)
 
+    def haveNone(self):
+        self._lenprefix = b'\x00\x00\x00\x01'
+        self._msgid = b'\x0f'
+        self._payload = b''
+        self._fullMessage = (self._lenprefix + self._msgid + self._payload)
+
+    def rejectRequest(self, value):
+        index, begin, length = value
+        self._lenprefix = struct.pack(">I", 13)
+        self._msgid = b'\x10'
+        self._payload = struct.pack(">III", index, begin, length)
+        self._fullMessage = (self._lenprefix + self._msgid + self._payload)
+
+    def allowedFast(self, value):
+        self._lenprefix = b'\x00\x00\x00\x05'
+        self._msgid = b'\x11'
+        self._payload = struct.pack(">I", value)
+        self._fullMessage = (self._lenprefix + self._msgid + self._payload)
+
+    def extended(self, value):
+        extendedId, body = value
+        self._lenprefix = struct.pack(">I", 2 + len(body))
+        self._msgid = b'\x14'
+        self._payload = bytes([extendedId]) + body
+        self._fullMessage = (self._lenprefix + self._msgid + self._payload)
+
+    # PIECE message whose block is streamed straight from disk with sendfile (never enters Python memory)
+    # fullMessage is only the 13 byte header, the block is described by fileSegment
+    def pieceFromFile(self, value):
+        length, index, begin, file, offset = value
+        self._lenprefix = struct.pack(">I", 9+length)
+        self._msgid = b'\x07'
+        self._payload = struct.pack(">II", index, begin)
+        self._fullMessage = (self._lenprefix + self._msgid + self._payload)
+        self._fileSegment = (file, offset, length)
+
+    # PIECE message whose block is sent from a buffer we already have (e.g. a cached piece), without copying it:
+    # fullMessage is only the 13 byte header, the block is a separate buffer that sendmsg gathers with it
+    def pieceFromBuffer(self, value):
+        length, index, begin, block = value
+        self._lenprefix = struct.pack(">I", 9+length)
+        self._msgid = b'\x07'
+        self._payload = struct.pack(">II", index, begin)
+        self._fullMessage = (self._lenprefix + self._msgid + self._payload)
+        self._block = memoryview(block).cast('B')
+
+# Per-connection receive buffer. fill() pulls in as much as the kernel has ready with one recv_into,
+# and nextMessage() hands back whole length-prefixed messages as (length, id, payload) tuples,
+# where payload is a memoryview into the buffer (no copying).
+# Note: payload views are only valid until the next fill(), copy them if you need to keep them around
+class messageReader:
+    def __init__(self, connection, bufferSize=RECV_BUFFER_SIZE):
+        self._connection = connection
+        self._buffer = bytearray(bufferSize)
+        self._view = memoryview(self._buffer)
+        # Unconsumed data lives in self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = 0
+
+    @property
+    def connection(self):
+        return self._connection
+
+    @property
+    def buffered(self):
+        return self._end - self._start
+
+    # Returns number of bytes read (0 means the peer closed the connection)
+    def fill(self):
+        # Move the leftover partial message to the front so all free space is in one piece
+        if self._start > 0:
+            remaining = self._end - self._start
+            if remaining:
+                self._view[:remaining] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = remaining
+        numBytes = self._connection.recv_into(self._view[self._end:])
+        self._end += numBytes
+        return numBytes
+
+    # Returns the next complete message, or None if we need to fill() first
+    def nextMessage(self):
+        available = self._end - self._start
+        if available < 4:
+            return None
+        length = int.from_bytes(self._view[self._start:self._start + 4], byteorder='big')
+        if length > MAX_MESSAGE_LENGTH:
+            raise Exception(f"Peer sent oversized message length prefix: {length}")
+        if available < 4 + length:
+            # Make sure the whole message will fit once the buffer is compacted
+            if 4 + length > len(self._buffer):
+                self._grow(4 + length)
+            return None
+
+        begin = self._start + 4
+        self._start = begin + length
+        if length == 0:
+            # length 0, id -1, empty bytes (A Stay Alive Message)
+            return (0, -1, b'')
+        return (length, self._buffer[begin], self._view[begin + 1:begin + length])
+
+    # Yields every complete message currently in the buffer
+    def messages(self):
+        message = self.nextMessage()
+        while message is not None:
+            yield message
+            message = self.nextMessage()
+
+    # Blocking read of exactly one message (only for sockets that are allowed to block/timeout)
+    def readMessage(self):
+        message = self.nextMessage()
+        while message is None:
+            if self.fill() == 0:
+                return None
+            message = self.nextMessage()
+        return message
+
+    def _grow(self, size):
+        # Can't resize a bytearray with exported views, so copy into a new one
+        newBuffer = bytearray(max(size, min(2 * len(self._buffer), MAX_MESSAGE_LENGTH + 4)))
+        remaining = self._end - self._start
+        newBuffer[:remaining] = self._view[self._start:self._end]
+        self._buffer = newBuffer
+        self._view = memoryview(newBuffer)
+        self._start = 0
+        self._end = remaining
+
+# Per-peer outbound queue. Control messages (CHOKE, UNCHOKE, HAVE, INTERESTED, REQUEST...) always go out
+# ahead of bulk PIECE data, and are coalesced into one sendmsg (writev) call together with the next PIECE header.
+# Queued PIECE responses are keyed by (index, begin, length) so a CANCEL removes them in O(1)
+# HAVEs for our new pieces (pushHave()) don't wake the writer: they ride along with the next batch that goes
+# out, as one buffer after the other control messages (see peer.queue_have/flush_haves)
+# push()/pushHave()/cancel() can be called from any thread, writeTo()/popBatch() only from the one thread doing the writing
+class outboundQueue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._control = deque()
+        self._haves = []
+        self._pieces = OrderedDict()
+        # Chunks (memoryviews / file segments) already taken off the queue by writeTo() but not fully written
+        self._chunks = deque()
+
+    @property
+    def pending(self):
+        return bool(self._chunks or self._control or self._pieces or self._haves)
+
+    @property
+    def havesPending(self):
+        return bool(self._haves)
+
+    # Returns False if the same PIECE response is already queued (a repeated REQUEST is answered once)
+    def push(self, message):
+        with self._lock:
+            if message.msgid == b'\x07':
+                index, begin = struct.unpack('>II', message.payload[:8])
+                length = int.from_bytes(message.lenprefix, byteorder='big') - 9
+                if (index, begin, length) in self._pieces:
+                    return False
+                self._pieces[(index, begin, length)] = message
+            else:
+                self._control.append(message)
+        return True
+
+    def pushHave(self, index):
+        with self._lock:
+            self._haves.append(index)
+
+    # Returns True if the PIECE response was still queued (and is now dropped)
+    def cancel(self, index, begin, length):
+        with self._lock:
+            return self._pieces.pop((index, begin, length), None) is not None
+
+    # Takes every queued control message plus the next PIECE off the queue, as a list of chunks
+    def popBatch(self):
+        with self._lock:
+            chunks = [memoryview(message.fullMessage) for message in self._control]
+            self._control.clear()
+            if self._haves:
+                chunks.append(memoryview(b''.join(struct.pack('>IBI', 5, HAVE, index) for index in self._haves)))
+                self._haves = []
+            if self._pieces:
+                key, message = self._pieces.popitem(last=False)
+                chunks.append(memoryview(message.fullMessage))
+                if message.block is not None:
+                    chunks.append(message.block)
+                if message.fileSegment is not None:
+                    chunks.append(message.fileSegment)
+        return chunks
+
+    # Writes as much as the socket takes (everything, if the socket blocks). Returns True once the queue is empty
+    # Note: a non-blocking socket raises BlockingIOError when it's full, just call again on the next EVENT_WRITE
+    def writeTo(self, connection):
+        while True:
+            if not self._chunks:
+                self._chunks.extend(self.popBatch())
+                if not self._chunks:
+                    return True
+
+            chunk = self._chunks[0]
+            if isinstance(chunk, memoryview):
+                # Every buffer up to the next file segment goes out in one system call
+                buffers = []
+                for chunk in self._chunks:
+                    if not isinstance(chunk, memoryview) or len(buffers) == MAX_IOV:
+                        break
+                    buffers.append(chunk)
+                self._consume(connection.sendmsg(buffers))
+            else:
+                # Block data goes from the page cache to the socket without a copy through Python
+                file, offset, length = chunk
+                if connection.gettimeout() != 0.0:
+                    # Blocking (thread mode) socket, socket.sendfile handles the waiting for us
+                    connection.sendfile(file, offset, length)
+                    self._chunks.popleft()
+                    continue
+                sent = os.sendfile(connection.fileno(), file.fileno(), offset, length)
+                if sent == 0:
+                    raise OSError("File ended before the requested block")
+                if sent < length:
+                    self._chunks[0] = (file, offset + sent, length - sent)
+                else:
+                    self._chunks.popleft()
+
+    def _consume(self, sent):
+        while sent:
+            chunk = self._chunks[0]
+            if len(chunk) <= sent:
+                sent -= len(chunk)
+                self._chunks.popleft()
+            else:
+                self._chunks[0] = chunk[sent:]
+                sent = 0
+
+# One piece being downloaded: a bytearray of the piece length, allocated once, that every block is copied
+# straight into at its offset, plus one flag per BLOCK_SIZE block. Completion is a counter check and the
+# hasher/writer get a view of the buffer itself (the piece is never joined or copied).
+# Blocks are also fed into a running SHA-1 as soon as everything before them is in, so a piece downloaded
+# in order is already hashed when its last block lands. Out of order blocks wait in the buffer until the
+# gap before them fills (if that gap is the last block, the rest is left to pieceVerifier instead of
+# hashing a whole piece in addBlock).
+# Requests are scheduled per block: claimBlock() hands out the next block nobody has asked for yet (whichever
+# peer asks), unclaimBlock() gives it back if the request fails, so several peers can share one piece.
+# Buffers come from piecePool and are reused for other pieces (reset()) once their piece is done
+class pieceBuffer:
+    def __init__(self, index, length):
+        self._buffer = bytearray(length)
+        self._view = memoryview(self._buffer)
+        self._received = bytearray((length + BLOCK_SIZE - 1) // BLOCK_SIZE)
+        self._requested = bytearray(len(self._received))
+        self.reset(index, length)
+
+    # Start over for another piece (length can't be larger than the capacity)
+    def reset(self, index, length):
+        self._index = index
+        self._length = length
+        self._numBlocks = (length + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self._received[:] = bytes(len(self._received))
+        self._numReceived = 0
+        self._requested[:] = bytes(len(self._requested))
+        # Blocks neither received nor requested, and where to start looking for one
+        self._unclaimed = self._numBlocks
+        self._claimCursor = 0
+        # A new object, a verifier may still be finishing the previous piece's hash
+        self._hasher = hashlib.sha1()
+        self._hashedBlocks = 0
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def length(self):
+        return self._length
+
+    @property
+    def capacity(self):
+        return len(self._buffer)
+
+    # The whole piece (only meaningful once complete)
+    @property
+    def data(self):
+        return self._view[:self._length]
+
+    @property
+    def complete(self):
+        return self._numReceived == self._numBlocks
+
+    # Running SHA-1 of the first 'hashed' bytes
+    @property
+    def hasher(self):
+        return self._hasher
+
+    @property
+    def hashed(self):
+        return min(self._hashedBlocks * BLOCK_SIZE, self._length)
+
+    @property
+    def unclaimed(self):
+        return self._unclaimed
+
+    # Marks the first block that is neither received nor requested as requested and returns its offset (None if there's none)
+    def claimBlock(self):
+        if self._unclaimed == 0:
+            return None
+        for blockNum in range(self._claimCursor, self._numBlocks):
+            if not self._received[blockNum] and not self._requested[blockNum]:
+                self._requested[blockNum] = 1
+                self._unclaimed -= 1
+                self._claimCursor = blockNum + 1
+                return blockNum * BLOCK_SIZE
+        return None
+
+    # The request for the block at begin won't be answered (rejected, peer gone...), someone else can claim it
+    def unclaimBlock(self, begin):
+        blockNum = begin // BLOCK_SIZE
+        if begin % BLOCK_SIZE != 0 or blockNum >= self._numBlocks or self._received[blockNum] or not self._requested[blockNum]:
+            return
+        self._requested[blockNum] = 0
+        self._unclaimed += 1
+        self._claimCursor = min(self._claimCursor, blockNum)
+
+    # True if the block starting at begin already arrived
+    def __contains__(self, begin):
+        return begin % BLOCK_SIZE == 0 and begin < self._length and self._received[begin // BLOCK_SIZE] == 1
+
+    # Copies block in at begin. Returns False (and keeps nothing) for duplicates and blocks that
+    # don't line up with our BLOCK_SIZE requests
+    def addBlock(self, begin, block):
+        if begin % BLOCK_SIZE != 0 or begin >= self._length or len(block) != min(BLOCK_SIZE, self._length - begin):
+            return False
+        blockNum = begin // BLOCK_SIZE
+        if self._received[blockNum]:
+            return False
+        self._view[begin:begin + len(block)] = block
+        self._received[blockNum] = 1
+        self._numReceived += 1
+        if not self._requested[blockNum]:
+            # Nobody claimed it (unrequested, or its request was given up on)
+            self._unclaimed -= 1
+        if blockNum == self._hashedBlocks and not (self.complete and self._numBlocks - blockNum > 1):
+            while self._hashedBlocks < self._numBlocks and self._received[self._hashedBlocks]:
+                start = self._hashedBlocks * BLOCK_SIZE
+                self._hasher.update(self._view[start:min(start + BLOCK_SIZE, self._length)])
+                self._hashedBlocks += 1
+        return True
+
+# Rarest first piece picker. Keeps the swarm availability of every piece (how many connected peers have it,
+# updated on BITFIELD/HAVE/HAVE ALL and disconnects) and the pieces nobody is downloading yet, grouped in
+# one bucket per availability. A pick looks at the rarest bucket first and starts at a random spot in it
+# (random tie-breaking, so peers don't all go for the same piece), so for a peer that has most pieces it
+# is O(1) plus sorting the handful of availability levels, and a pick never tries more than PICK_SCAN_LIMIT
+# of them before going through the pieces the peer has instead. Availability changes move a piece between
+# buckets in O(1) (swap with the last one and pop).
+# Pieces are taken out by pick()/take() when a peer starts on them and go back with put().
+# In streaming mode (see setWindow) the pieces in a window just past the read position are picked first,
+# lowest index first, and rarest first is only used once nothing in the window can be requested
+class piecePicker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._windowStart = 0
+        self._windowSize = 0
+        self.reset(0, [])
+
+    # numPieces pieces, of which 'missing' still need downloading
+    def reset(self, numPieces, missing):
+        with self._lock:
+            self._numPieces = numPieces
+            self._availability = array('i', bytes(4 * numPieces))
+            # Position of every waiting piece in its bucket (-1 = not waiting: we have it or a peer is on it)
+            self._position = array('i', [-1]) * numPieces
+            self._buckets = {}
+            self._waiting = 0
+            self._endgame = False
+            for index in missing:
+                self._add(index)
+
+    def __len__(self):
+        return self._waiting
+
+    def __contains__(self, index):
+        return 0 <= index < self._numPieces and self._position[index] >= 0
+
+    def availability(self, index):
+        return self._availability[index]
+
+    # Streaming: prefer pieces [start, start + size). A size of 0 turns it off
+    def setWindow(self, start, size):
+        with self._lock:
+            self._windowStart = start
+            self._windowSize = size
+
+    @property
+    def window(self):
+        return (self._windowStart, self._windowSize)
+
+    def _add(self, index):
+        bucket = self._buckets.setdefault(self._availability[index], [])
+        self._position[index] = len(bucket)
+        bucket.append(index)
+        self._waiting += 1
+
+    def _remove(self, index):
+        level = self._availability[index]
+        bucket = self._buckets[level]
+        position = self._position[index]
+        last = bucket.pop()
+        if last != index:
+            bucket[position] = last
+            self._position[last] = position
+        elif not bucket:
+            del self._buckets[level]
+        self._position[index] = -1
+        self._waiting -= 1
+
+    def _adjust(self, index, change):
+        if self._position[index] >= 0:
+            self._remove(index)
+            self._availability[index] += change
+            self._add(index)
+        else:
+            self._availability[index] += change
+
+    # A peer's bitfield changed (BITFIELD, HAVE ALL...): its old pieces don't count any more, its new ones do.
+    # Either can be None
+    def updatePeer(self, old, new):
+        with self._lock:
+            for bitfield, change in ((old, -1), (new, 1)):
+                if bitfield is None:
+                    continue
+                for index in bitfield.findall([1]):
+                    if index >= self._numPieces:
+                        break
+                    self._adjust(index, change)
+
+    # A peer announced one more piece (HAVE)
+    def peerHas(self, index):
+        with self._lock:
+            if index < self._numPieces:
+                self._adjust(index, 1)
+
+    # Takes the rarest waiting piece canRequest(index) accepts. Pieces in 'started' (in progress, so they
+    # already have a buffer, see piecesInProgress: only as many as the '-m' budget holds) go before the rest, and with canStart False only those are considered.
+    # The streaming window, if any, goes before both. 'candidates' are the pieces the peer could be asked for
+    # (see _rarest). Returns None if there is nothing to pick
+    def pick(self, canRequest, started, canStart, candidates):
+        with self._lock:
+            best = None
+            for index in range(self._windowStart, min(self._windowStart + self._windowSize, self._numPieces)):
+                if index in self and (canStart or index in started) and canRequest(index):
+                    self._remove(index)
+                    return index
+            for index in started:
+                if index in self and canRequest(index) and (best is None or self._availability[index] < self._availability[best]):
+                    best = index
+            if best is None and canStart:
+                best = self._rarest(canRequest, candidates)
+            if best is not None:
+                self._remove(best)
+            return best
+
+    # Rarest waiting piece canRequest accepts. The buckets are walked (rarest first, random start) for at most
+    # PICK_SCAN_LIMIT pieces; if none of those is for this peer, most waiting pieces aren't, so the pieces it
+    # could request ('candidates') are gone through instead. Call with _lock held
+    def _rarest(self, canRequest, candidates):
+        scanned = 0
+        for level in sorted(self._buckets):
+            # Nobody connected has these
+            if level <= 0:
+                continue
+            bucket = self._buckets[level]
+            start = random.randrange(len(bucket))
+            for i in range(len(bucket)):
+                if scanned == PICK_SCAN_LIMIT:
+                    break
+                scanned += 1
+                index = bucket[(start + i) % len(bucket)]
+                if canRequest(index):
+                    return index
+            if scanned == PICK_SCAN_LIMIT:
+                break
+        else:
+            return None
+        best = None
+        for index in candidates:
+            if index in self and self._availability[index] > 0 and canRequest(index) and (best is None or self._availability[index] < self._availability[best]):
+                best = index
+        return best
+
+    # Takes a specific piece (a suggested one). Returns False if it isn't waiting
+    def take(self, index):
+        with self._lock:
+            if index not in self:
+                return False
+            self._remove(index)
+            return True
+
+    # Gives a piece back (peer gone or choked, failed hash or write)
+    def put(self, index):
+        with self._lock:
+            if 0 <= index < self._numPieces and self._position[index] < 0:
+                self._add(index)
+                # Someone can start on it again, so duplicate requests aren't needed until it's taken
+                self._endgame = False
+
+    # Set once a peer has no waiting piece left to request and starts on duplicate requests (see
+    # peer._endgame_block), cleared when a piece is put back
+    @property
+    def endgame(self):
+        return self._endgame
+
+    # Returns True if this call is the one that started endgame
+    def enterEndgame(self):
+        with self._lock:
+            if self._endgame:
+                return False
+            self._endgame = True
+            return True
+
+    # True if canRequest(index) accepts any waiting piece that someone connected has
+    def anyRequestable(self, canRequest, candidates):
+        with self._lock:
+            return self._rarest(canRequest, candidates) is not None
+
+    # True if any waiting piece is in the bitfield (is the peer interesting)
+    def anyIn(self, bitfield):
+        with self._lock:
+            for level, bucket in self._buckets.items():
+                if level <= 0:
+                    continue
+                for index in bucket:
+                    if index < len(bitfield) and bitfield[index]:
+                        return True
+            return False
+
+# Reusable pieceBuffers under a memory budget (bytes). acquire() returns None once the buffers in use
+# would go over the budget, which is the picker's signal to finish pieces in progress before starting new ones.
+# One buffer is always allowed so a tiny budget still makes progress
+class bufferPool:
+    def __init__(self, budget):
+        self._lock = threading.Lock()
+        self._budget = budget
+        self._free = []
+        # Bytes of every buffer we own (in use + free) and of the ones in use
+        self._allocated = 0
+        self._bytesInUse = 0
+        self._inUse = 0
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @budget.setter
+    def budget(self, value):
+        self._budget = value
+
+    @property
+    def inUse(self):
+        return self._inUse
+
+    @property
+    def bytesInUse(self):
+        return self._bytesInUse
+
+    @property
+    def allocated(self):
+        return self._allocated
+
+    @property
+    def free(self):
+        return len(self._free)
+
+    # True if a new piece of this length could get a buffer right now
+    def hasRoom(self, length):
+        with self._lock:
+            return self._hasRoom(self._fit(length), length)
+
+    # The smallest free buffer that holds length bytes (index into _free), or None. Call with _lock held
+    def _fit(self, length):
+        best = None
+        for i, freeBuffer in enumerate(self._free):
+            if freeBuffer.capacity >= length and (best is None or freeBuffer.capacity < self._free[best].capacity):
+                best = i
+        return best
+
+    # A buffer is charged its capacity, so a reused buffer bigger than the piece counts in full. Call with _lock held
+    def _hasRoom(self, fit, length):
+        capacity = length if fit is None else self._free[fit].capacity
+        return self._inUse == 0 or self._bytesInUse + capacity <= self._budget
+
+    def acquire(self, index, length):
+        with self._lock:
+            fit = self._fit(length)
+            if not self._hasRoom(fit, length):
+                return None
+            if fit is not None:
+                buffer = self._free.pop(fit)
+                buffer.reset(index, length)
+            else:
+                # Free buffers that are too small only take up budget, drop them before allocating
+                while self._free and self._allocated + length > self._budget:
+                    self._allocated -= self._free.pop().capacity
+                buffer = pieceBuffer(index, length)
+                self._allocated += length
+            self._inUse += 1
+            self._bytesInUse += buffer.capacity
+            return buffer
+
+    def release(self, buffer):
+        with self._lock:
+            self._inUse -= 1
+            self._bytesInUse -= buffer.capacity
+            if self._allocated > self._budget:
+                # Budget was lowered (or we're over it because of the one buffer that is always allowed)
+                self._allocated -= buffer.capacity
+            else:
+                self._free.append(buffer)
+
+    def __str__(self):
+        return f"piece buffers: {self._inUse} in use ({self._bytesInUse / 2**20:.1f}/{self._budget / 2**20:.0f} MiB), {len(self._free)} free"
+
+# The output file(s). Each file is preallocated once (posix_fallocate, or a sparse ftruncate where that isn't
+# supported) and pieces are written with os.pwrite/pwritev at their own offset, so they can complete in any
+# order, and uploads read (or sendfile) from the same descriptors. Existing data is never truncated (a file
+# larger than expected gets a warning and is left as it is).
+# A multi-file torrent is one contiguous byte range cut into files: the span index is just the start offset
+# of every file (array of int64, 8 bytes per file) plus its path, and a (offset, length) range is mapped to
+# file segments with a binary search, so a piece costs one positional I/O call per file it touches.
+# files = [(relative path, length), ...] in torrent order, None for a single file torrent (path, length)
+class storage:
+    def __init__(self, path, length, files=None, preallocate=True):
+        self._path = path
+        self._length = length
+        if files is None:
+            files = [(None, length)]
+        self._paths = []
+        self._starts = array('q')
+        offset = 0
+        for relPath, size in files:
+            self._paths.append(path if relPath is None else os.path.join(path, relPath))
+            self._starts.append(offset)
+            offset += size
+        if offset != length:
+            raise Exception("File lengths add up to %d bytes, expected %d" % (offset, length))
+        # Open file objects, least recently used first. Only MAX_OPEN_FILES are kept, an evicted one is
+        # closed once the last reference to it is gone (a sendfile still queued keeps its file open), so
+        # whoever uses a descriptor keeps its file object in a local until the system call is done
+        self._handles = OrderedDict()
+        self._handlesLock = threading.Lock()
+        # Files written since the last sync (an evicted file still has to be fsync'd)
+        self._unsynced = set()
+        if preallocate:
+            for i in range(len(self._paths)):
+                self._preallocate(i)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def length(self):
+        return self._length
+
+    @property
+    def count(self):
+        return len(self._paths)
+
+    def _size(self, i):
+        end = self._starts[i + 1] if i + 1 < len(self._starts) else self._length
+        return end - self._starts[i]
+
+    # Unbuffered file object for file i (the descriptor is used directly, and by socket.sendfile/loop.sendfile)
+    def _handle(self, i):
+        with self._handlesLock:
+            handle = self._handles.get(i)
+            if handle is not None:
+                self._handles.move_to_end(i)
+                return handle
+            fd = os.open(self._paths[i], os.O_RDWR | os.O_CREAT, 0o644)
+            handle = os.fdopen(fd, 'r+b', buffering=0)
+            self._handles[i] = handle
+            if len(self._handles) > MAX_OPEN_FILES:
+                self._handles.popitem(last=False)
+            return handle
+
+    def _preallocate(self, i):
+        directory = os.path.dirname(self._paths[i])
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The file object stays referenced while its descriptor is used (an evicted one is closed with its last reference)
+        handle = self._handle(i)
+        fd = handle.fileno()
+        length = self._size(i)
+        size = os.fstat(fd).st_size
+        if size > length:
+            # Not ours to cut short (maybe the wrong file), the torrent's part of it is used as it is
+            print("Warning: %s is %d bytes, larger than the %d bytes the torrent expects. Leaving the rest of it alone" % (self._paths[i], size, length))
+        elif size < length:
+            try:
+                os.posix_fallocate(fd, size, length - size)
+            except (AttributeError, OSError):
+                # No fallocate (platform or filesystem), a sparse file still gives every piece its place
+                os.ftruncate(fd, length)
+
+    # [(file index, offset in that file, length), ...] covering offset .. offset + length
+    def segments(self, offset, length):
+        if offset < 0 or offset + length > self._length:
+            raise Exception("Range %d+%d is outside of the torrent (%d bytes)" % (offset, length, self._length))
+        result = []
+        # Last file starting at or before offset (skips empty files that start at the same place)
+        i = bisect.bisect_right(self._starts, offset) - 1
+        while length > 0:
+            size = min(length, self._starts[i] + self._size(i) - offset)
+            if size > 0:
+                result.append((i, offset - self._starts[i], size))
+                offset += size
+                length -= size
+            i += 1
+        return result
+
+    # (file object, offset in it) when the whole range is in one file (so it can be sendfile'd), else None
+    def locate(self, offset, length):
+        segments = self.segments(offset, length)
+        if len(segments) != 1:
+            return None
+        i, fileOffset, size = segments[0]
+        return self._handle(i), fileOffset
+
+    def write(self, offset, data):
+        self.writev(offset, [data])
+
+    # Several buffers that are contiguous in the torrent, one pwritev per file they touch where pwritev exists
+    def writev(self, offset, buffers):
+        views = deque(memoryview(data).cast('B') for data in buffers)
+        total = sum(len(view) for view in views)
+        for i, fileOffset, size in self.segments(offset, total):
+            # Split off the part of the buffers that belongs in this file
+            part = []
+            while size:
+                view = views.popleft()
+                if len(view) > size:
+                    views.appendleft(view[size:])
+                    view = view[:size]
+                part.append(view)
+                size -= len(view)
+            self._pwritev(self._handle(i), fileOffset, part)
+            with self._handlesLock:
+                self._unsynced.add(i)
+
+    def _pwritev(self, handle, offset, views):
+        fd = handle.fileno()
+        if not hasattr(os, 'pwritev'):
+            for view in views:
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    view = view[written:]
+                    offset += written
+            return
+        views = deque(views)
+        while views:
+            written = os.pwritev(fd, list(views)[:MAX_IOV], offset)
+            offset += written
+            while views and written >= len(views[0]):
+                written -= len(views.popleft())
+            if written:
+                views[0] = views[0][written:]
+
+    def read(self, offset, length):
+        segments = self.segments(offset, length)
+        if len(segments) == 1:
+            i, fileOffset, size = segments[0]
+            handle = self._handle(i)
+            return os.pread(handle.fileno(), size, fileOffset)
+        data = bytearray(length)
+        view = memoryview(data)
+        for i, fileOffset, size in segments:
+            handle = self._handle(i)
+            view[:size] = os.pread(handle.fileno(), size, fileOffset)
+            view = view[size:]
+        return bytes(data)
+
+    # (size, mtime in ns) of every file, for the fast-resume file
+    def stat(self):
+        stats = []
+        for path in self._paths:
+            st = os.stat(path)
+            stats.append((st.st_size, st.st_mtime_ns))
+        return stats
+
+    def sync(self):
+        with self._handlesLock:
+            unsynced, self._unsynced = self._unsynced, set()
+        for i in sorted(unsynced):
+            handle = self._handle(i)
+            os.fsync(handle.fileno())
+
+    def close(self):
+        with self._handlesLock:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles.clear()
+
+# Writes verified pieces on its own thread, so no peer (or engine loop) ever waits on the disk.
+# Pieces queued at the same time are sorted and adjacent ones go out as one sequential pwritev.
+# fsyncEvery: None = never fsync, 0 = only once everything is written (close()), N = every N bytes written
+# submit()'s callback runs on the writer thread with True/False once the data is (or failed to be) written,
+# any failure (not only an OSError) is reported that way and the writer carries on with the next pieces.
+# The queue holds at most maxPending pieces (0 = no limit). A piece's buffer only goes back to piecePool
+# once it's written, so with maxPending = as many buffers as the memory budget allows (see
+# utils.getDiskWriter) a slow disk holds up new pieces instead of piling them up, and submit() never has
+# to wait (it's called with the pieces mutexes held and the callbacks need them)
+class diskWriter:
+    def __init__(self, storage, fsyncEvery=0, maxPending=0):
+        self._storage = storage
+        self._fsyncEvery = fsyncEvery
+        self._queue = queue.Queue(maxPending)
+        self._sinceSync = 0
+        self._written = 0
+        self._writes = 0
+        # Offsets of pieces written since the last fsync (not kept with the 'never' policy, see unsynced())
+        self._unsynced = set()
+        self._unsyncedLock = threading.Lock()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    # Bytes written and number of write system calls (pieces / writes = coalescing factor)
+    @property
+    def written(self):
+        return self._written
+
+    @property
+    def writes(self):
+        return self._writes
+
+    # Offsets of the written pieces that aren't fsync'd yet under the '-f' policy, the fast-resume file
+    # doesn't vouch for them (see utils.saveResume). Always empty with 'never': nothing is fsync'd, as asked
+    def unsynced(self):
+        with self._unsyncedLock:
+            return set(self._unsynced)
+
+    def _synced(self):
+        with self._unsyncedLock:
+            self._unsynced.clear()
+
+    def submit(self, offset, data, callback):
+        self._queue.put((offset, data, callback))
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Take everything else that's already waiting
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                batch.sort(key=lambda item: item[0])
+
+                start = 0
+                for i in range(1, len(batch) + 1):
+                    if i < len(batch) and batch[i - 1][0] + len(batch[i - 1][1]) == batch[i][0]:
+                        continue
+                    self._writeRun(batch[start:i])
+                    start = i
+            except Exception as e:
+                # (_writeRun reports its own failures, nothing may stop the writer)
+                print("Disk writer error:", e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _writeRun(self, run):
+        ok = True
+        try:
+            self._storage.writev(run[0][0], [data for offset, data, callback in run])
+            size = sum(len(data) for offset, data, callback in run)
+            self._written += size
+            self._writes += 1
+            self._sinceSync += size
+            if self._fsyncEvery is not None:
+                with self._unsyncedLock:
+                    self._unsynced.update(offset for offset, data, callback in run)
+            if self._fsyncEvery and self._sinceSync >= self._fsyncEvery:
+                self._storage.sync()
+                self._synced()
+                self._sinceSync = 0
+        except Exception as e:
+            print("Disk write failed at offset", run[0][0], e)
+            ok = False
+        for offset, data, callback in run:
+            try:
+                callback(ok)
+            except Exception as e:
+                if DEBUG_MODE:
+                    print("disk writer callback exception:", e)
+                    traceback.print_exc()
+
+    # Waits until every submitted piece is written, then fsyncs unless the policy is 'never'
+    def close(self):
+        self._queue.join()
+        if self._fsyncEvery is not None:
+            self._storage.sync()
+            self._synced()
+
+# Verifies completed pieces on a pool of hashing threads, so the peer that delivered the last block (or the
+# engine loop) never waits on SHA-1 and several pieces are hashed at once: hashlib releases the GIL while
+# it hashes a buffer, so this spreads over as many cores as there are workers.
+# submit() gets the piece's running hasher (see pieceBuffer) and the part of the piece it hasn't seen yet.
+# The callback runs on a hashing thread with True/False once the piece is hashed, no lock is held
+# while hashing (a complete piece buffer doesn't change until its result is applied)
+class pieceVerifier:
+    def __init__(self, workers):
+        self._workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._verified = 0
+        self._failed = 0
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def verified(self):
+        return self._verified
+
+    @property
+    def failed(self):
+        return self._failed
+
+    def submit(self, index, hasher, data, expected, callback):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(self._workers, thread_name_prefix="verifier")
+            self._pending += 1
+        self._executor.submit(self._verify, index, hasher, data, expected, callback)
+
+    def _verify(self, index, hasher, data, expected, callback):
+        hasher.update(data)
+        ok = hasher.digest() == expected
+        try:
+            callback(ok)
+        except Exception as e:
+            if DEBUG_MODE:
+                print("verifier callback exception for piece", index, e)
+                traceback.print_exc()
+        # Only counted as done once its result is applied (the download isn't finished while anything is pending)
+        with self._lock:
+            self._pending -= 1
+            if ok:
+                self._verified += 1
+            else:
+                self._failed += 1
+
+# Size-bounded LRU cache of verified pieces for the upload path. The first REQUEST for a piece (block 0)
+# queues a read-ahead of the whole piece, one pread on the cache's own thread, and the blocks requested
+# after it are served from memory. Blocks of pieces that aren't cached are still sendfile'd from disk
+class pieceCache:
+    def __init__(self, capacity):
+        self._lock = threading.Lock()
+        self._capacity = capacity
+        # piece index -> bytes, least recently used first
+        self._pieces = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._loading = set()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @capacity.setter
+    def capacity(self, value):
+        self._capacity = value
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def size(self):
+        return self._size
+
+    # Returns the piece's data, or None (a miss) if it isn't cached
+    def get(self, index):
+        with self._lock:
+            data = self._pieces.get(index)
+            if data is None:
+                self._misses += 1
+                return None
+            self._pieces.move_to_end(index)
+            self._hits += 1
+            return data
+
+    def readAhead(self, storage, index, offset, length):
+        with self._lock:
+            if length > self._capacity or index in self._pieces or index in self._loading:
+                return
+            self._loading.add(index)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run)
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((storage, index, offset, length))
+
+    def run(self):
+        while True:
+            storage, index, offset, length = self._queue.get()
+            try:
+                data = storage.read(offset, length)
+            except OSError as e:
+                if DEBUG_MODE:
+                    print("Read-ahead failed for piece", index, e)
+                data = None
+            with self._lock:
+                self._loading.discard(index)
+                if data is None or len(data) != length:
+                    continue
+                self._pieces[index] = data
+                self._size += length
+                while self._size > self._capacity:
+                    evicted, evictedData = self._pieces.popitem(last=False)
+                    self._size -= len(evictedData)
+
+    def __str__(self):
+        return f"upload cache: {self._hits} hits, {self._misses} misses ({self._size / 2**20:.1f}/{self._capacity / 2**20:.0f} MiB)"
+
+# Streaming mode: writes the torrent's data in order to a pipe, FIFO or socket while it downloads. It waits
+# for the piece at its position to be written to disk (pieceReady() is called once one is), then streams
+# every consecutive piece that's there (up to STREAM_CHUNK bytes per write) and moves the picker's window
+# past the new position so the next pieces are downloaded first. Multi-file torrents are streamed as
+# their files back to back
+class pieceStream:
+    def __init__(self, output, storage, pieceLength, length):
+        self._output = output
+        self._storage = storage
+        self._pieceLength = pieceLength
+        self._length = length
+        self._numPieces = math.ceil(length / pieceLength)
+        self._window = max(1, STREAM_WINDOW // pieceLength)
+        # Next piece to stream
+        self._position = 0
+        self._streamed = 0
+        self._ready = threading.Condition()
+        self._thread = None
+
+    @property
+    def position(self):
+        return self._position
+
+    @property
+    def streamed(self):
+        return self._streamed
+
+    def start(self):
+        picker.setWindow(self._position, self._window)
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def pieceReady(self):
+        with self._ready:
+            self._ready.notify()
+
+    def run(self):
+        try:
+            while self._position < self._numPieces:
+                with self._ready:
+                    while piecesStatus.get(self._position, 0) is not None:
+                        self._ready.wait(1)
+                end = self._position + 1
+                while end < self._numPieces and (end - self._position) * self._pieceLength < STREAM_CHUNK and piecesStatus.get(end, 0) is None:
+                    end += 1
+                offset = self._position * self._pieceLength
+                size = min(end * self._pieceLength, self._length) - offset
+                self._output.write(self._storage.read(offset, size))
+                self._output.flush()
+                self._streamed += size
+                self._position = end
+                picker.setWindow(self._position, self._window)
+            # EOF for the reader
+            self._output.close()
+        except (OSError, ValueError) as e:
+            # Reader went away, the download goes on without the window
+            print("Streaming stopped at byte", self._streamed, e)
+        picker.setWindow(0, 0)
+
+    # Waits until everything is streamed (or streaming failed)
+    def close(self):
+        if self._thread is not None:
+            self._thread.join()
+
 class trackerScrapeMsg:
     def __init__(self):
         self._complete = None
@@ -193,17 +1427,46 @@ class peer:
         self._amChoking = None
         self._amInterested = None
         self._peerBitfield = None
+        # True while the peer's pieces count towards piece availability (see piecePicker)
+        self._in_swarm = None
         self._connection = None
+        self._reader = None
         self._trackerInfo = None
         self._lock = None
         self._is_connected = None
         self._max_pipeline = None
-        self._curr_reqs_in_progress = None
-        self._cancelled_request = None
+        # Requests in flight: (index, begin, length) -> time sent
+        self._outstanding = None
+        self._wakeup = None
+        self._rtt = None
+        self._min_rtt = None
+        self._rate = None
+        # Last time the peer sent us a block (or we started waiting on it again), and whether it's snubbing us
+        self._last_block = None
+        self._snubbed = None
+        self._outbound = None
+        self._write_ready = None
         self._last_data_downloaded = None
         self._cur_data_downloaded = None
         self._last_message_received = None
         self._isAlive = None
+        # Only set when the peer is driven by a selectorEngine instead of its own threads
+        self._engine = None
+        self._current_piece = None
+        # BEP 6 state: whether both sides set the Fast Extension bit, pieces the peer lets us request while
+        # it chokes us, pieces we let it request while we choke it, its SUGGEST PIECE hints and pieces it rejected
+        self._fastExtension = None
+        self._allowed_fast = None
+        self._allowed_fast_out = None
+        self._suggested = None
+        self._rejected_pieces = None
+        # BEP 10 state: whether both sides set the Extension Protocol bit, the peer's extended message ids
+        # by name, its listening port (from the extended handshake) and the addresses we last sent it with PEX
+        self._extensionProtocol = None
+        self._extensions = None
+        self._listen_port = None
+        self._pex_sent = None
+        self._last_pex = None
 
     @property
     def peerId(self):
@@ -218,6 +1481,15 @@ class peer:
     def connection(self):
         return self._connection
 
+    @property
+    def reader(self):
+        return self._reader
+
+    # Use this to hand over a reader that already has buffered data (e.g. from reading the bitfield at connect time)
+    @reader.setter
+    def reader(self, value):
+        self._reader = value
+
     @property
     def is_connected(self):
         return self._is_connected
@@ -234,6 +1506,45 @@ class peer:
     def peerChoked(self, value):
         self._peerChoked = value
 
+    # Snubbed peers get no regular unchoke slot, only the optimistic one (see utils.unchoke_algorithm)
+    @property
+    def snubbed(self):
+        return self._snubbed
+
+    # CHOKE: without the Fast Extension the peer throws away our requests, so give their blocks back right
+    # away (a Fast Extension peer REJECTs each one instead, or still serves it)
+    def got_choked(self):
+        self._peerChoked = True
+        if not self._fastExtension:
+            self.drop_requests()
+            self.release_piece()
+
+    # Called every tick: requests that took too long go back to the scheduler (with a CANCEL, in case the
+    # block still comes), and a peer that sent nothing for SNUB_TIMEOUT while we wait on it is snubbed:
+    # one request at a time until it delivers again
+    def check_requests(self):
+        now = time.time()
+        timeout = max(REQUEST_TIMEOUT, REQUEST_TIMEOUT_RTTS * (self._rtt or 0))
+        with self._lock:
+            expired = [key for key, sentAt in self._outstanding.items() if now - sentAt > timeout]
+            for key in expired:
+                del self._outstanding[key]
+            snub = not self._snubbed and bool(self._outstanding or expired) and now - self._last_block > SNUB_TIMEOUT
+            if snub:
+                self._snubbed = True
+                self._max_pipeline = 1
+        for index, begin, length in expired:
+            self._unclaim(index, begin)
+            cancel = messages()
+            cancel.cancel((index, begin, length))
+            self._send(cancel)
+        if expired or snub:
+            if DEBUG_MODE:
+                print(f"Peer {self._peerAddr}: {len(expired)} requests timed out" + (", snubbed" if snub else ""))
+            # Someone else can own our piece now
+            self.release_piece()
+            self._wakeup.set()
+
     @property
     def peerInterested(self):
         return self._peerInterested
@@ -264,15 +1575,23 @@ class peer:
     
     @peerBitfield.setter
     def peerBitfield(self, value):
-        self._peerBitfield = value
+        with self._lock:
+            if self._in_swarm:
+                picker.updatePeer(self._peerBitfield, value)
+            self._peerBitfield = value
+
+    # The peer is gone: its pieces no longer count towards availability and the blocks we asked it for
+    # can be requested from other peers (safe to call more than once)
+    def leave_swarm(self):
+        with self._lock:
+            if self._in_swarm:
+                self._in_swarm = False
+                picker.updatePeer(self._peerBitfield, None)
+        self.drop_requests()
 
     @property
-    def cancelled_request(self):
-        return self._cancelled_request
-    
-    @cancelled_request.setter
-    def cancelled_request(self, value):
-        self._cancelled_request = value
+    def outbound(self):
+        return self._outbound
 
     @property
     def last_data_downloaded(self):
@@ -302,6 +1621,42 @@ class peer:
     def isAlive(self):
         return self._isAlive
 
+    @isAlive.setter
+    def isAlive(self, value):
+        self._isAlive = value
+
+    @property
+    def fastExtension(self):
+        return self._fastExtension
+
+    @fastExtension.setter
+    def fastExtension(self, value):
+        self._fastExtension = value
+
+    @property
+    def extensionProtocol(self):
+        return self._extensionProtocol
+
+    @extensionProtocol.setter
+    def extensionProtocol(self, value):
+        self._extensionProtocol = value
+
+    @property
+    def extensions(self):
+        return self._extensions
+
+    @property
+    def allowedFastOut(self):
+        return self._allowed_fast_out
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @engine.setter
+    def engine(self, value):
+        self._engine = value
+
 
     
     
@@ -312,9 +1667,14 @@ class peer:
         self._peerPort = port
         self._peerId = id
         self._peerBitfield = bitfield # Note: do not rely on length of stored bitfield to be == to length of pieces
+        self._in_swarm = True
         self._connection = connection
+        self._reader = messageReader(connection)
         self._trackerInfo = trackerInfo
         self._lock = threading.Lock() # Avoid calling send/recv at the same time and editing 
+        self._outbound = outboundQueue()
+        # Thread mode: wakes write_messages when something was queued
+        self._write_ready = threading.Event()
         self._is_connected = True
         # A choked peer is not allowed to request any pieces from the other peer.
         self._peerChoked = True
@@ -324,27 +1684,55 @@ class peer:
         self._amChoking = True
         self._amInterested = False
         self._max_pipeline = 5
-        self._curr_reqs_in_progress = 0
+        self._outstanding = {}
+        # Set whenever something happened that may let us send more requests (download_pieces waits on it)
+        self._wakeup = threading.Event()
+        # Smoothed RTT, windowed minimum RTT (see _block_received) and download rate in bytes/sec
+        self._rtt = None
+        self._min_rtt = None
+        self._min_rtt_window = None
+        self._min_rtt_window_start = time.time()
+        self._rate = 0
+        self._rate_bytes = 0
+        self._rate_start = time.time()
+        self._last_block = time.time()
+        self._snubbed = False
         self._last_data_downloaded = 0
         self._cur_data_downloaded = 0
         self._isAlive = True
         self._last_message_received = time.time()
-        
+        self._current_piece = None
+        self._fastExtension = False
+        self._allowed_fast = set()
+        self._allowed_fast_out = set()
+        self._suggested = deque()
+        self._rejected_pieces = set()
+        self._extensionProtocol = False
+        self._extensions = {}
+        self._listen_port = None
+        self._pex_sent = set()
+        self._last_pex = time.time()
+
     def run_main_logic(self):
         try:
             # Start listening and downloading threads
             listenThread = threading.Thread(target= self.listen_for_messages)
             downloadThread = threading.Thread(target=self.download_pieces)
+            writeThread = threading.Thread(target=self.write_messages)
             listenThread.daemon = True
             downloadThread.daemon = True
+            writeThread.daemon = True
             listenThread.start()
             downloadThread.start()
+            writeThread.start()
 
             # Send a alive message every ~2 minutes
             aliveMsgInterval = 0
             while trackerRequestMsg.left > 0:
                 # Send interested/not interested based on bitfield
                 self.determine_interested()
+                self.send_pex()
+                self.flush_haves()
                 now = time.time()
                 aliveMsgInterval += now
                 # Check if the last message received is longago
@@ -369,115 +1757,36 @@ class peer:
         finally:
             with self._lock:
                 self._isAlive = False
+            self.leave_swarm()
             self._connection.close()
 
 
-    # This will run as long as piece taken is not downloaded yet. Returns False if faulty piece, True if completed
-    def _download_attempt(self, index, num_blocks):
+    # Event driven: sends requests whenever a block arrives (or we get unchoked, a HAVE, ...)
+    # instead of polling, with a short timeout as a safety net
+    def download_pieces(self):
         try:
-            exception_raised = False
-            if index not in piecesStatus:
-                piecesStatus[index] = 0
-            if index not in piecesCollection:
-                piecesCollection[index] = {}
-            while piecesStatus[index] != None and self.isAlive:   
-                # Iterate over blocks at 16KB interval offsets         
-                for i in [x*16000 for x in range(num_blocks)]:
-                    # Check how many requests are in flight
-                    if self._curr_reqs_in_progress < self._max_pipeline and self._curr_reqs_in_progress < num_blocks:
-                    # Checking for blocks that haven't been downloaded
-                        if (piecesCollection[index] is not None) and i not in piecesCollection[index]:
-                            request = messages()
-                            length = 16000
-                            pieceLength = self._trackerInfo.pieceLength
-
-                            # This is for edge case of last piece (may have smaller piece length than others)
-                            isLastPiece = False
-                            maxPieceIndex = max(piecesCollection)  
-                            print("maxPieceIndex -", maxPieceIndex, "self._trackerInfo.length -", self._trackerInfo.length, 'self._trackerInfo.pieceLength', self._trackerInfo.pieceLength)
-                            print("Modified piece length -", self._trackerInfo.length - (maxPieceIndex * pieceLength))
-                            if self._trackerInfo.length - (maxPieceIndex * pieceLength) < self._trackerInfo.pieceLength:
-                                print("KDHBLKDJBHLKDJHKFHFHLJFHLKJFHL")
-                                isLastPiece = True
-                                pieceLength = self._trackerInfo.length - (maxPieceIndex * pieceLength)
-
-                            if (i > pieceLength):
-                                continue
-                            # if i is the index of the last block, calculate length of the last block
-                            print("i + length = ", i + length, ", pieceLength -", pieceLength)
-                            if (i + length) > pieceLength:    
-                                print("HAHAHAHAHAHAHAHAHAHA")                      
-                                length = pieceLength - i
-                            # Make a request message with piece index, block index, and length of block
-                            request.request((index, i, length))
-                            # Send a request through our own socket
-                            with self._lock:
-                                self._connection.sendall(request.fullMessage)
-                                self._curr_reqs_in_progress += 1
-                                print("SENT REQUEST MESSAGE!!! -", self.peerAddr)
-                                print("length -", length, "Piece Index -", index, "Block Index -", i)
-                    else:
-                        # If we have max reqs in progress, we wait for 2 seconds
-                        time.sleep(2) 
-                        break
-                # If at some point, verifyHash determines that the piece is wrong (and pop the index) 
-                if index not in piecesStatus:
-                    # Return piece index to top of the workDeque
-                    with workDequeMutex:
-                        workDeque.appendleft(index)
-                    return False
-            # Whole piece is finished
-            return True
+            while trackerRequestMsg.left > 0 and self.isAlive:
+                self._wakeup.wait(timeout=1)
+                self._wakeup.clear()
+                self.check_requests()
+                self.queue_requests()
         except Exception as e:
-            exception_raised = True
             if DEBUG_MODE:
                 print(f"exception for peer requesting pieces at: {self._peerAddr}\n")
                 print(e)
                 traceback.print_exc()
-
-            return
         finally:
-            if exception_raised:
-                with workDequeMutex:
-                    workDeque.appendleft(index)
-
-        
-
-                
+            self.release_piece()
 
-    def download_pieces(self):
-        while trackerRequestMsg.left > 0 and self.isAlive:
-            time.sleep(2)
-            print("Current requests in flight -", self._curr_reqs_in_progress)
-            print("Peer ", self)
-            print("How many left - ", trackerRequestMsg.left)
-
-            if not self.peerChoked:
-                for i in range(len(workDeque)):
-                    if self._peerBitfield[workDeque[i]]:
-                        index = workDeque[i]
-                        with workDequeMutex:
-                            workDeque.remove(index)
-                        break
-                # 16000B = 16KB = Max block length
-                num_blocks = math.ceil(self._trackerInfo.pieceLength/16000)
-                print("Number of blocks -", num_blocks)
-                is_completed = self._download_attempt(index, num_blocks)   
-                if not is_completed:
-                    if DEBUG_MODE:
-                        print(f"Download attempt for piece {index} at peer {self._peerID} failed")
-
-        print("EXITED THREAD FOR DOWNLOADING PIECES")
+        if DEBUG_MODE:
+            print("EXITED THREAD FOR DOWNLOADING PIECES")
 
     def determine_interested(self):
         interested = messages()
         contains_needed_pieces = False
-        # Look at what pieces' indices we have left to do
-        for x in workDeque:
-            # If peer bitfield contains this index, we would be interested
-            if self._peerBitfield[x]:
-                contains_needed_pieces = True
-                break
+        # If peer bitfield contains any piece nobody is downloading yet, we would be interested
+        if picker.anyIn(self._peerBitfield):
+            contains_needed_pieces = True
 
         # If peer contains something I need:
         # 1: I was not interested (I now need some piece and am interested again): send interested 
@@ -490,13 +1799,12 @@ class peer:
             if not self._amInterested:
                 self._amInterested = True
                 interested.interested()
-                with self._lock:
-                    self._connection.sendall(interested.fullMessage)
+                self._send(interested)
         else:
             if self._amInterested:
+                self._amInterested = False
                 interested.notinterested()
-                with self._lock:
-                    self._connection.sendall(interested.fullMessage)
+                self._send(interested)
 
     def listen_for_messages(self):
 
@@ -518,40 +1826,985 @@ class peer:
 
             else:
                 with self._lock:
-                    # Get message from socket 
-                    message = utils.get_message_from_sock(self._connection)
-                    if message is None:
+                    # Pull in everything the kernel has ready (one recv for many messages)
+                    if self._reader.fill() == 0:
                         raise Exception("Didn't get message from sock")
                     self.last_message_received = time.time()
-                    # Indicate we processed 1 in flight request
-                    if message[1] == PIECE:
-                        self._curr_reqs_in_progress -= 1
-
 
-                # Send the entire Msg to parsePeerMsg (could be optimised here)
-                utils.parsePeerMsg(message, self._trackerInfo, self)
+                # Hand every complete message in the buffer to parsePeerMsg
+                for message in self._reader.messages():
+                    self.handle_message(message)
+
+    # Book-keeping for one received message, then parse it
+    def handle_message(self, message):
+        if message[1] == PIECE and message[0] >= 9:
+            index, begin = struct.unpack('>II', message[2][:8])
+            self._block_received(index, begin, message[0] - 9)
+        utils.parsePeerMsg(message, self._trackerInfo, self)
+        # Anything (a block, UNCHOKE, HAVE, BITFIELD...) may let us request more
+        self._wakeup.set()
+
+    # Updates RTT/throughput estimates from a received block and resizes the pipeline to cover the
+    # bandwidth-delay product. The minimum RTT is used (not the smoothed one) because once the pipe is
+    # full, extra requests only queue up at the peer and inflate the RTT we measure
+    def _block_received(self, index, begin, length):
+        now = time.time()
+        with self._lock:
+            self._last_block = now
+            if self._snubbed:
+                self._snubbed = False
+                self._max_pipeline = MIN_PIPELINE
+                if DEBUG_MODE:
+                    print("Peer no longer snubbed -", self._peerAddr)
+            sentAt = self._outstanding.pop((index, begin, length), None)
+            if sentAt is None:
+                # Not something we asked for (or already timed out)
+                return
+            self._cur_data_downloaded += length
+
+            sample = now - sentAt
+            self._rtt = sample if self._rtt is None else 0.875 * self._rtt + 0.125 * sample
+            if self._min_rtt_window is None or sample < self._min_rtt_window:
+                self._min_rtt_window = sample
+            if self._min_rtt is None or sample < self._min_rtt:
+                self._min_rtt = sample
+            if now - self._min_rtt_window_start > MIN_RTT_WINDOW:
+                # Forget old minimums so a changed route can raise the estimate again
+                self._min_rtt = self._min_rtt_window
+                self._min_rtt_window = None
+                self._min_rtt_window_start = now
+
+            self._rate_bytes += length
+            elapsed = now - self._rate_start
+            if elapsed >= RATE_SAMPLE_INTERVAL:
+                sampleRate = self._rate_bytes / elapsed
+                self._rate = sampleRate if self._rate == 0 else 0.5 * self._rate + 0.5 * sampleRate
+                self._rate_bytes = 0
+                self._rate_start = now
+                # 25% + 2 requests above the BDP: keeps growing while the peer keeps up, settles once it doesn't
+                bdpBlocks = self._rate * self._min_rtt / BLOCK_SIZE
+                self._max_pipeline = max(MIN_PIPELINE, min(MAX_PIPELINE, math.ceil(bdpBlocks * 1.25) + 2))
+                if DEBUG_MODE:
+                    print(f"Peer {self._peerAddr}: rate {self._rate / 1000:.1f}KB/s, min RTT {self._min_rtt * 1000:.1f}ms, pipeline {self._max_pipeline}")
+
+    # Non-blocking request pipelining (used by download_pieces and the engines):
+    # keeps up to _max_pipeline requests in flight. Blocks are scheduled one at a time (see _next_block)
+    def queue_requests(self):
+        # While choked we can still ask for the peer's allowed fast pieces (BEP 6)
+        while (not self._peerChoked or self._allowed_fast) and self._isAlive and len(self._outstanding) < self._max_pipeline:
+            block = self._next_block()
+            if block is None:
+                # Everything we could ask this peer for is requested, wait for the blocks to come in
+                return
+            index, begin = block
+            length = min(BLOCK_SIZE, utils.getPieceLength(index, self._trackerInfo) - begin)
+            request = messages()
+            request.request((index, begin, length))
+            with self._lock:
+                now = time.time()
+                if not self._outstanding:
+                    # Nothing was asked of it until now (e.g. it only just unchoked us), the snub clock starts here
+                    self._last_block = now
+                self._outstanding[(index, begin, length)] = now
+            self._send(request)
+
+    # Where the next request goes, as (index, begin), or None. In order of preference:
+    # 1. the next unrequested block of our own piece (a piece stays on one peer as long as that peer keeps up,
+    #    so a bad piece has one suspect)
+    # 2. a piece in progress whose owner is gone, snubbed us or gave up on it (its requests timed out, see
+    #    _disown), which becomes ours
+    # 3. a new piece from the picker
+    # 4. only if we couldn't start one (memory budget used up, nothing left in the picker for us): an
+    #    unrequested block of a piece another peer is working on and keeping up with
+    # 5. endgame: a block that's requested from another peer but hasn't arrived yet
+    def _next_block(self):
+        index = self._current_piece
+        # (read once, a hashing or writer thread can throw the piece away at any time)
+        status = piecesStatus.get(index, -1) if index is not None else None
+        if status == -1:
+            # The piece failed its hash and was thrown away, give it back to the picker
+            self.release_piece()
+            index = None
+        elif index is not None and status is None:
+            # Done (verified and written)
+            self._current_piece = index = None
+        with piecesCollectionMutex:
+            if index is not None and self._can_request(index):
+                begin = self._claim(index)
+                if begin is not None:
+                    return index, begin
+            # Only the pieces in progress that still have unrequested blocks are looked at
+            for other in piecesClaimable:
+                owner = pieceOwners.get(other)
+                if (owner is None or not owner.isAlive or owner.snubbed) and self._can_request(other):
+                    break
+            else:
+                other = None
+            if other is not None:
+                begin = self._claim(other)
+                if begin is not None:
+                    # (it may be waiting in the picker too, released by its old owner)
+                    picker.take(other)
+                    pieceOwners[other] = self
+                    self._current_piece = other
+                    return other, begin
+        index = self._take_piece()
+        if index is not None:
+            with piecesCollectionMutex:
+                begin = self._claim(index)
+            if begin is not None:
+                return index, begin
+        with piecesCollectionMutex:
+            other = next((i for i in piecesClaimable if self._can_request(i)), None)
+            if other is not None:
+                begin = self._claim(other)
+                if begin is not None:
+                    return other, begin
+        return self._endgame_block()
+
+    # Claims the next unrequested block of a piece in progress, None if there's none. Needs piecesCollectionMutex
+    def _claim(self, index):
+        buffer = piecesInProgress.get(index)
+        if buffer is None:
+            return None
+        begin = buffer.claimBlock()
+        if buffer.unclaimed == 0:
+            piecesClaimable.discard(index)
+        return begin
+
+    # Take the rarest piece this peer has that nobody is downloading (see piecePicker), a piece it suggested goes first.
+    # Pieces already in progress (they have a buffer) go before new ones, and once piecePool is out of
+    # budget only those are taken
+    def _take_piece(self):
+        index = None
+        canStart = piecePool.hasRoom(self._trackerInfo.pieceLength)
+        with piecesCollectionMutex:
+            started = set(piecesInProgress)
+        while self._suggested:
+            i = self._suggested.popleft()
+            if self._can_request(i) and (canStart or i in started) and picker.take(i):
+                index = i
+                break
+        if index is None:
+            index = picker.pick(self._can_request, started, canStart, self._candidates())
+            if index is None:
+                return None
+        with piecesStatusMutex:
+            with piecesCollectionMutex:
+                if index not in piecesStatus:
+                    buffer = piecePool.acquire(index, utils.getPieceLength(index, self._trackerInfo))
+                    if buffer is None:
+                        # Another peer took the last of the budget
+                        picker.put(index)
+                        return None
+                    piecesStatus[index] = 0
+                    piecesCollection[index] = buffer
+                    piecesInProgress[index] = buffer
+                    piecesClaimable.add(index)
+                pieceOwners[index] = self
+        self._current_piece = index
+        return index
+
+    # Endgame: once no waiting piece is one this peer can request (a piece nobody connected has would
+    # otherwise hold it back forever) and every block of the pieces in progress is requested, a peer with
+    # nothing to do asks for blocks that are still on their way from another peer, so the last pieces don't
+    # wait on the slowest peer. Whichever copy arrives first is kept and the other requests for it are
+    # cancelled (see utils.cancelDuplicateRequests)
+    def _endgame_block(self):
+        if picker.anyRequestable(self._can_request, self._candidates()):
+            return None
+        with self._lock:
+            asked = set((index, begin) for index, begin, length in self._outstanding)
+        with piecesCollectionMutex:
+            candidates = []
+            for index, buffer in piecesInProgress.items():
+                if buffer.complete or not self._can_request(index):
+                    continue
+                for begin in range(0, buffer.length, BLOCK_SIZE):
+                    if begin not in buffer and (index, begin) not in asked:
+                        candidates.append((index, begin))
+        if not candidates:
+            return None
+        if picker.enterEndgame():
+            if DEBUG_MODE:
+                print("Entering endgame,", len(candidates), "blocks left")
+        return random.choice(candidates)
 
+    # Endgame: someone else delivered this block, take back our request for it. Returns True if we had asked for it
+    def cancel_request(self, index, begin, length):
+        with self._lock:
+            if self._outstanding.pop((index, begin, length), None) is None:
+                return False
+        cancel = messages()
+        cancel.cancel((index, begin, length))
+        self._send(cancel)
+        return True
+
+    # Pieces we could ask this peer for: its allowed fast set while it chokes us, otherwise what it has
+    def _candidates(self):
+        if self._peerChoked:
+            return list(self._allowed_fast)
+        return self._peerBitfield.findall([1])
+
+    def _can_request(self, index):
+        if index >= len(self._peerBitfield) or not self._peerBitfield[index] or index in self._rejected_pieces:
+            return False
+        return not self._peerChoked or index in self._allowed_fast
+
+    # Give an unfinished piece back to the picker (disconnect, failed hash or rejected). Its blocks that are
+    # requested from us stay claimed until they arrive or drop_requests() gives them back
+    def release_piece(self):
+        index = self._current_piece
+        self._current_piece = None
+        if index is not None:
+            self._disown(index)
+        if index is not None and piecesStatus.get(index, 0) is not None:
+            # (a failed piece may already be back, see utils.pieceMismatched, put() ignores it then)
+            picker.put(index)
+
+    # Forget every request in flight and let other peers claim those blocks
+    def drop_requests(self):
+        with self._lock:
+            dropped = list(self._outstanding)
+            self._outstanding.clear()
+        for index, begin, length in dropped:
+            self._unclaim(index, begin)
+
+    def _unclaim(self, index, begin):
+        with piecesCollectionMutex:
+            # (the piece may be done or thrown away, its buffer moved on to another piece)
+            buffer = piecesInProgress.get(index)
+            if buffer is not None:
+                buffer.unclaimBlock(begin)
+                if buffer.unclaimed:
+                    piecesClaimable.add(index)
+            # An earlier piece of ours we've moved on from: we gave up on a block of it, another peer can take it over
+            # (the current one stays ours unless release_piece gives it up)
+            if index != self._current_piece and pieceOwners.get(index) is self:
+                del pieceOwners[index]
+
+    # The piece is no longer ours (another peer may take it over, see _next_block)
+    def _disown(self, index):
+        with piecesCollectionMutex:
+            if pieceOwners.get(index) is self:
+                del pieceOwners[index]
 
     def set_have(self, index):
-        if index <= len(self._peerBitfield):
-            self._peerBitfield.set(1, index)
+        with self._lock:
+            if index < len(self._peerBitfield) and not self._peerBitfield[index]:
+                self._peerBitfield.set(1, index)
+                if self._in_swarm:
+                    picker.peerHas(index)
+
+    # First messages after the handshake: what we already have. With the Fast Extension that is always
+    # sent (HAVE ALL/HAVE NONE instead of a full or empty bitfield), followed by our allowed fast set.
+    # With the Extension Protocol the extended handshake comes last
+    def send_initial_messages(self, always=False):
+        ownBitfield = utils.getOwnBitfield(self._trackerInfo)
+        message = messages()
+        if self._fastExtension and ownBitfield.all(True):
+            message.haveAll()
+            self._send(message)
+        elif self._fastExtension and not ownBitfield.any(True):
+            message.haveNone()
+            self._send(message)
+        elif always or ownBitfield.any(True):
+            message.bitfield(ownBitfield.tobytes())
+            self._send(message)
+
+        if self._extensionProtocol:
+            extendedHandshake = messages()
+            extendedHandshake.extended((EXTENDED_HANDSHAKE, utils.getExtendedHandshake()))
+            self._send(extendedHandshake)
+
+        if self._fastExtension and ownBitfield.any(True):
+            for index in utils.getAllowedFastSet(self._peerAddr, trackerRequestMsg.infoHash, len(self._trackerInfo.pieces)):
+                if ownBitfield[index]:
+                    self._allowed_fast_out.add(index)
+                    allowed = messages()
+                    allowed.allowedFast(index)
+                    self._send(allowed)
+
+    # Extended handshake: remember the peer's extended message ids and its listening port
+    def extended_handshake(self, extensions, listenPort):
+        self._extensions = extensions
+        if listenPort is not None and 0 < listenPort < 65536:
+            self._listen_port = listenPort
+            knownPeers.add((self._peerAddr, listenPort), dial=False)
+
+    # Address other peers can connect to, if we know one (outbound connections go to the listening port)
+    @property
+    def listenAddr(self):
+        if self._listen_port is not None:
+            return (self._peerAddr, self._listen_port)
+        if (self._peerAddr, self._peerPort) in knownPeers:
+            return (self._peerAddr, self._peerPort)
+        return None
+
+    # HAVE for a piece we just got, batched (see outboundQueue.pushHave). Skipped if the peer already has
+    # the piece, which also means a seeder never gets any
+    def queue_have(self, index):
+        bitfield = self._peerBitfield
+        if bitfield is not None and index < len(bitfield) and bitfield[index]:
+            return
+        self._outbound.pushHave(index)
+
+    # Makes sure batched HAVEs go out even if nothing else is sent (called every tick)
+    def flush_haves(self):
+        if self._outbound.havesPending:
+            if self._engine is not None:
+                self._engine.want_write(self)
+            else:
+                self._write_ready.set()
+
+    # ut_pex (BEP 11): every PEX_INTERVAL, tell the peer which of our connected peers came and went
+    def send_pex(self):
+        pexId = self._extensions.get(b'ut_pex')
+        now = time.time()
+        if not pexId or now - self._last_pex < PEX_INTERVAL:
+            return
+        self._last_pex = now
+        connected = set()
+        for p in peer_obj_list:
+            if p is not self and p.isAlive and p.listenAddr is not None:
+                connected.add(p.listenAddr)
+        added = list(connected - self._pex_sent)[:MAX_PEX_PEERS]
+        dropped = list(self._pex_sent - connected)[:MAX_PEX_PEERS]
+        if not added and not dropped:
+            return
+        self._pex_sent.update(added)
+        self._pex_sent.difference_update(dropped)
+        pexMsg = messages()
+        pexMsg.extended((pexId, utils.getPexMessage(added, dropped)))
+        self._send(pexMsg)
+
+    def allow_fast(self, index):
+        if index < len(self._trackerInfo.pieces):
+            self._allowed_fast.add(index)
+
+    def suggest_piece(self, index):
+        if index < len(self._trackerInfo.pieces):
+            self._suggested.append(index)
+
+    # REJECT REQUEST: the block can be asked for again right away instead of waiting for a timeout
+    def request_rejected(self, index, begin, length):
+        with self._lock:
+            if self._outstanding.pop((index, begin, length), None) is None:
+                return
+        self._unclaim(index, begin)
+        if not self._peerChoked:
+            # It isn't choking us but still won't serve this piece, let another peer have it
+            self._rejected_pieces.add(index)
+            if index == self._current_piece:
+                self.release_piece()
     
+    # Queues a message. Never blocks: the socket is written by write_messages (thread mode) or the engine
     def send_message(self, message):
-        # Wait for potential cancel
-        time.sleep(1)
-        #If current message sending out is a piece message
-        if message.msgid == b'\x07':
-            # If theres a request cancelled
-            if self._cancelled_request is not None:
-                # If current message sent == cancelled request
-                msgBody = struct.unpack('>II', message.payload[:8])
-                if msgBody[0] == self._cancelled_request[0] and msgBody[1]== self._cancelled_request[1]:
-                    # Clear cancelled request and return
-                    self._cancelled_request = None
-                    return
+        return self._send(message)
+
+    # Drops a queued PIECE response the peer cancelled. Returns True if it hadn't been sent yet
+    def cancel_piece(self, index, begin, length):
+        return self._outbound.cancel(index, begin, length)
+
+    def _send(self, message):
+        if not self._outbound.push(message):
+            return False
+        if self._engine is not None:
+            self._engine.want_write(self)
+        else:
+            self._write_ready.set()
+        return True
+
+    # Thread mode only: the one thread writing to the socket, so a slow send never stalls the listening thread
+    def write_messages(self):
+        try:
+            while self.isAlive:
+                self._write_ready.wait(timeout=1)
+                self._write_ready.clear()
+                self._outbound.writeTo(self._connection)
+        except Exception as e:
+            if DEBUG_MODE:
+                print(f"exception for peer writing messages at: {self._peerAddr}\n")
+                print(e)
+            self._isAlive = False
+
+
+# Outbound connects and handshakes as non-blocking state machines on a selector, shared by peerDialer (thread
+# mode) and selectorEngine. Up to MAX_CONCURRENT_DIALS connects are in flight at once, every attempt (and every
+# inbound connection still owing us its handshake) has its own deadline, and once a handshake checks out the
+# connection goes to the subclass's _promote(). Subclasses run the loop: _startDials() once per iteration,
+# _handleHandshake() for ready sockets whose key.data is a state dict, _expireHandshakes() now and then
+class handshakeDialer:
+    CONNECTING = 0
+    HANDSHAKING = 1
+
+    def __init__(self, trackerInfo, handshakeMsg):
+        self._trackerInfo = trackerInfo
+        self._handshakeMsg = handshakeMsg
+        self._selector = selectors.DefaultSelector()
+        # Outbound addresses waiting for a dial slot (connect() can be called from any thread)
+        self._dialQueue = deque()
+        self._dials = 0
+        # Connections that haven't finished the handshake yet: socket -> state dict
+        self._handshaking = {}
+        # Lets other threads interrupt select()
+        self._wakeReader, self._wakeWriter = socket.socketpair()
+        self._wakeReader.setblocking(False)
+        self._wakeWriter.setblocking(False)
+        self._selector.register(self._wakeReader, selectors.EVENT_READ, data=None)
+
+    @property
+    def dialing(self):
+        return self._dials
+
+    @property
+    def queued(self):
+        return len(self._dialQueue)
+
+    # Open an outbound connection to (ip, port)
+    def connect(self, addr):
+        self._dialQueue.append(addr)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeWriter.send(b'\x00')
+        except BlockingIOError:
+            # Already has a pending wake-up
+            pass
+
+    def _drainWake(self):
+        try:
+            while self._wakeReader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    # Start as many outbound connects as there are free dial slots
+    def _startDials(self):
+        while self._dialQueue and self._dials < MAX_CONCURRENT_DIALS:
+            addr = self._dialQueue.popleft()
+            connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                connection.setblocking(False)
+                err = connection.connect_ex(addr)
+                if err not in (0, errno.EINPROGRESS):
+                    raise OSError(err, errno.errorcode.get(err, "connect failed"))
+                state = {'state': self.CONNECTING, 'addr': addr, 'inbound': False, 'data': b'', 'deadline': time.time() + CONNECT_TIMEOUT}
+                self._selector.register(connection, selectors.EVENT_WRITE, data=state)
+                self._handshaking[connection] = state
+                self._dials += 1
+                if DEBUG_MODE:
+                    print("Trying to connect to", addr)
+            except OSError as e:
+                connection.close()
+                if DEBUG_MODE:
+                    print("Failed to connect to", addr, e)
+
+    # An inbound connection (accepted elsewhere) that still has to send its handshake, we answer once it's valid
+    def _addInbound(self, connection, addr):
+        try:
+            connection.setblocking(False)
+            state = {'state': self.HANDSHAKING, 'addr': addr, 'inbound': True, 'data': b'', 'deadline': time.time() + HANDSHAKE_TIMEOUT}
+            self._handshaking[connection] = state
+            self._selector.register(connection, selectors.EVENT_READ, data=state)
+        except OSError as e:
+            if DEBUG_MODE:
+                print("Couldn't register connection to", addr, e)
+
+    # Takes a connection out of the handshake bookkeeping (and frees its dial slot), it stays registered
+    def _forgetHandshake(self, connection):
+        state = self._handshaking.pop(connection, None)
+        if state is not None and not state['inbound']:
+            self._dials -= 1
+        return state
+
+    def _closeHandshake(self, connection):
+        self._forgetHandshake(connection)
+        try:
+            self._selector.unregister(connection)
+        except (KeyError, ValueError):
+            pass
+        connection.close()
+
+    def _handleHandshake(self, connection):
+        state = self._handshaking[connection]
+        try:
+            if state['state'] == self.CONNECTING:
+                err = connection.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err != 0:
+                    raise OSError(err, errno.errorcode.get(err, "connect failed"))
+                if DEBUG_MODE:
+                    print("Connected to client!", state['addr'])
+                connection.send(self._handshakeMsg)
+                state['state'] = self.HANDSHAKING
+                state['deadline'] = time.time() + HANDSHAKE_TIMEOUT
+                self._selector.modify(connection, selectors.EVENT_READ, data=state)
+                return
+
+            # Only read what's left of the 68 byte handshake, the rest belongs to the peer's reader
+            chunk = connection.recv(68 - len(state['data']))
+            if not chunk:
+                raise OSError("Peer closed connection during handshake")
+            state['data'] += chunk
+            if len(state['data']) < 68:
+                return
+
+            peerIdBytes = utils.checkHandshake(state['data'], trackerRequestMsg.infoHash)
+            if peerIdBytes is None:
+                raise OSError("Invalid handshake")
+            if state['inbound']:
+                connection.send(self._handshakeMsg)
+            self._forgetHandshake(connection)
+            self._promote(connection, state, peerIdBytes)
+        except OSError as e:
+            if DEBUG_MODE:
+                print("Dropping connection to", state['addr'], e)
+            self._closeHandshake(connection)
+
+    def _expireHandshakes(self, now):
+        for connection, state in list(self._handshaking.items()):
+            if now > state['deadline']:
+                if DEBUG_MODE:
+                    print("Connect/handshake timed out -", state['addr'])
+                self._closeHandshake(connection)
+
+    # Handshake validated: the connection (still registered with the selector) is the subclass's now
+    def _promote(self, connection, state, peerIdBytes):
+        raise NotImplementedError
+
+# Thread mode's outbound connections on one selector thread (see handshakeDialer). A peer gets its threads as
+# soon as its handshake checks out (its BITFIELD is read by its listening thread like any other message)
+class peerDialer(handshakeDialer):
+    def run(self):
+        while True:
+            self._startDials()
+            for key, mask in self._selector.select(timeout=ENGINE_TICK):
+                if key.data is None:
+                    self._drainWake()
+                elif key.fileobj in self._handshaking:
+                    self._handleHandshake(key.fileobj)
+            self._expireHandshakes(time.time())
+
+    # Hand the connection over to a peer running on its own threads
+    def _promote(self, connection, state, peerIdBytes):
+        self._selector.unregister(connection)
+        connection.setblocking(True)
+
+        ip, port = state['addr']
+        newPeer = peer()
+        newPeer.peerId = (ip, port, peerIdBytes, BitArray(length=len(self._trackerInfo.pieces)), connection, self._trackerInfo)
+        newPeer.fastExtension = utils.supportsFastExtension(state['data'])
+        newPeer.extensionProtocol = utils.supportsExtensionProtocol(state['data'])
+        newPeer.send_initial_messages()
+        peerThread = threading.Thread(target=newPeer.run_main_logic)
+        peerThread.daemon = True
+        peerThread.start()
+        peer_obj_list.append(newPeer)
+        if DEBUG_MODE:
+            print("Peer active -", state['addr'])
+
+# Every peer address we've heard of (tracker, PEX), so each one is dialed at most once.
+# New addresses go straight to the connector (the thread mode peerDialer or an engine), if one is set
+class peerPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._known = set()
+        self._connector = None
+
+    @property
+    def connector(self):
+        return self._connector
+
+    @connector.setter
+    def connector(self, value):
+        self._connector = value
+
+    def __contains__(self, addr):
+        return addr in self._known
+
+    def __len__(self):
+        return len(self._known)
+
+    # Returns True if addr wasn't known yet
+    def add(self, addr, dial=True):
         with self._lock:
-            self._connection.sendall(message.fullMessage)
+            if addr in self._known:
+                return False
+            self._known.add(addr)
+        if dial and self._connector is not None:
+            if DEBUG_MODE:
+                print("New peer address -", addr)
+            self._connector.connect(addr)
+        return True
+
+# Single-threaded engine: one selector owns every peer socket and drives outbound connects, handshakes,
+# reads, writes, request pipelining and keep-alives as non-blocking state machines.
+# A whole swarm costs one thread instead of three per peer. Other threads (listener, unchoke algorithm)
+# only go through connect()/addConnection()/want_write(), which wake the selector up
+class selectorEngine(handshakeDialer):
+    def __init__(self, trackerInfo, handshakeMsg):
+        handshakeDialer.__init__(self, trackerInfo, handshakeMsg)
+        # Inbound sockets handed over from the listening thread, registered by the loop
+        self._pending = deque()
+        # Active peers -> time we last wrote to them
+        self._lastSent = {}
+        # Peers with new messages in their outbound queue (other threads add to it too)
+        self._dirty = set()
+        self._dirtyLock = threading.Lock()
+        self._loopThread = None
+
+    @property
+    def peers(self):
+        return list(self._lastSent)
+
+    # Take over an inbound connection accepted by the listening thread (we still need its handshake)
+    def addConnection(self, connection, addr):
+        self._pending.append((connection, addr))
+        self._wake()
+
+    # Called by peer.send_message: the message is already in the peer's outbound queue, write it
+    # at the end of this loop iteration (so everything queued meanwhile goes out in one sendmsg)
+    def want_write(self, peer):
+        with self._dirtyLock:
+            self._dirty.add(peer)
+        if threading.current_thread() is not self._loopThread:
+            self._wake()
+
+    def run(self):
+        self._loopThread = threading.current_thread()
+        lastTick = 0
+        while True:
+            for key, mask in self._selector.select(timeout=ENGINE_TICK):
+                if key.data is None:
+                    self._drainWake()
+                elif isinstance(key.data, dict):
+                    # Handshake state (skip if we already closed it during this iteration)
+                    if key.fileobj in self._handshaking:
+                        self._handleHandshake(key.fileobj)
+                else:
+                    self._handlePeer(key.data, mask)
+
+            while self._pending:
+                self._addInbound(*self._pending.popleft())
+            self._startDials()
+
+            now = time.time()
+            if now - lastTick >= ENGINE_TICK:
+                lastTick = now
+                self._tick(now)
+
+            # Write everything queued during this iteration (one pass per peer)
+            with self._dirtyLock:
+                dirty, self._dirty = self._dirty, set()
+            for p in dirty:
+                self._flush(p)
+
+    # Turn the connection into a peer driven by this engine
+    def _promote(self, connection, state, peerIdBytes):
+        ip, port = state['addr']
+        newPeer = peer()
+        newPeer.peerId = (ip, port, peerIdBytes, BitArray(length=len(self._trackerInfo.pieces)), connection, self._trackerInfo)
+        newPeer.fastExtension = utils.supportsFastExtension(state['data'])
+        newPeer.extensionProtocol = utils.supportsExtensionProtocol(state['data'])
+        newPeer.engine = self
+        self._lastSent[newPeer] = time.time()
+        self._selector.modify(connection, selectors.EVENT_READ, data=newPeer)
+        peer_obj_list.append(newPeer)
+
+        # Tell the peer what we already have
+        newPeer.send_initial_messages(always=state['inbound'])
+        if DEBUG_MODE:
+            print("Engine peer active -", state['addr'])
 
+    def _handlePeer(self, p, mask):
+        if mask & selectors.EVENT_WRITE:
+            self._flush(p)
+        if not (mask & selectors.EVENT_READ) or not p.isAlive:
+            return
+        try:
+            if p.reader.fill() == 0:
+                raise OSError("Peer closed the connection")
+            p.last_message_received = time.time()
+            for message in p.reader.messages():
+                p.handle_message(message)
+            p.queue_requests()
+        except BlockingIOError:
+            pass
+        except Exception as e:
+            if DEBUG_MODE:
+                print(f"exception for engine peer at: {p.peerAddr}\n")
+                print(e)
+                traceback.print_exc()
+            self._drop(p)
+
+    def _flush(self, p):
+        if p not in self._lastSent:
+            return
+        try:
+            done = p.outbound.writeTo(p.connection)
+            self._lastSent[p] = time.time()
+        except BlockingIOError:
+            done = False
+        except OSError as e:
+            if DEBUG_MODE:
+                print("Engine write failed for", p.peerAddr, e)
+            self._drop(p)
+            return
+
+        # Only ask for EVENT_WRITE while there is something left to write
+        events = selectors.EVENT_READ
+        if not done:
+            events |= selectors.EVENT_WRITE
+        self._selector.modify(p.connection, events, data=p)
+
+    def _drop(self, p):
+        if self._lastSent.pop(p, None) is None:
+            return
+        self._dirty.discard(p)
+        try:
+            self._selector.unregister(p.connection)
+        except (KeyError, ValueError):
+            pass
+        p.isAlive = False
+        p.release_piece()
+        p.leave_swarm()
+        p.connection.close()
+
+    # Timeouts, keep-alives, interest and requests (anything not triggered by a read)
+    def _tick(self, now):
+        self._expireHandshakes(now)
+
+        for p in list(self._lastSent):
+            try:
+                if now - p.last_message_received > PEER_TIMEOUT:
+                    raise Exception("Peer timed out")
+                p.determine_interested()
+                p.send_pex()
+                p.flush_haves()
+                p.check_requests()
+                if now - self._lastSent[p] > KEEP_ALIVE_INTERVAL:
+                    alive = messages()
+                    alive.keepAlive()
+                    p.send_message(alive)
+                p.queue_requests()
+            except Exception as e:
+                if DEBUG_MODE:
+                    print(f"exception for engine peer at: {p.peerAddr}\n")
+                    print(e)
+                self._drop(p)
+
+# asyncio version of the engine: every peer is a coroutine on top of asyncio streams, so the client can be
+# embedded in an asyncio service (await asyncioEngine.run(...)). Handshake, message codec and piece flow are
+# awaits that wake on I/O readiness instead of sleep-polling. Like selectorEngine, other threads only go
+# through connect()/write(), which hop onto the event loop
+class asyncioEngine:
+    def __init__(self, trackerInfo, handshakeMsg):
+        self._trackerInfo = trackerInfo
+        self._handshakeMsg = handshakeMsg
+        self._loop = None
+        self._loopThread = None
+        self._server = None
+        # peer -> asyncio.StreamWriter
+        self._writers = {}
+        # peer -> event that wakes the peer's write loop
+        self._wakeups = {}
+        self._tasks = set()
+        # Bounds the outbound connects/handshakes in flight
+        self._dials = None
+
+    @property
+    def peers(self):
+        return list(self._writers)
+
+    # Connect to every (ip, port) in peerList and (if port is given) accept peers on port. Runs until cancelled
+    async def run(self, peerList, port=None):
+        self._loop = asyncio.get_running_loop()
+        self._loopThread = threading.current_thread()
+        self._dials = asyncio.Semaphore(MAX_CONCURRENT_DIALS)
+        if port is not None:
+            self._server = await asyncio.start_server(self._acceptPeer, '', port)
+        for addr in peerList:
+            self._spawn(self._connectPeer(addr))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            if self._server is not None:
+                self._server.close()
+            for task in list(self._tasks):
+                task.cancel()
+
+    # Thread-safe: open an outbound connection to (ip, port)
+    def connect(self, addr):
+        if threading.current_thread() is self._loopThread:
+            self._spawn(self._connectPeer(addr))
+        else:
+            self._loop.call_soon_threadsafe(lambda: self._spawn(self._connectPeer(addr)))
+
+    # Thread-safe: called by peer.send_message once the message is in the peer's outbound queue
+    def want_write(self, peer):
+        if threading.current_thread() is self._loopThread:
+            self._wakeWriter(peer)
+        else:
+            self._loop.call_soon_threadsafe(self._wakeWriter, peer)
+
+    def _wakeWriter(self, peer):
+        wakeup = self._wakeups.get(peer)
+        if wakeup is not None:
+            wakeup.set()
+
+    # Writes are serialized through one coroutine per peer (sendfile can't be interleaved with other writes)
+    async def _writeLoop(self, p, writer):
+        wakeup = self._wakeups[p]
+        while True:
+            await wakeup.wait()
+            wakeup.clear()
+            while p.outbound.pending:
+                # Control messages, the next PIECE header and a block from memory go into the transport
+                # together (writelines, no joining), a block from disk is sendfile'd after them
+                buffers = []
+                for chunk in p.outbound.popBatch():
+                    if isinstance(chunk, memoryview):
+                        buffers.append(chunk)
+                        continue
+                    writer.writelines(buffers)
+                    buffers = []
+                    file, offset, length = chunk
+                    await writer.drain()
+                    await self._loop.sendfile(writer.transport, file, offset, length)
+                if buffers:
+                    writer.writelines(buffers)
+                await writer.drain()
+
+    # The write loop only ends by being cancelled, anything else is a failed write: the peer is dead and
+    # its read side (blocked in readMessage) is cancelled so _runPeer cleans it up
+    def _writerDone(self, p, readSide, task):
+        if task.cancelled():
+            return
+        error = task.exception()
+        if DEBUG_MODE:
+            print(f"asyncio engine write failed for {p.peerAddr}:", error)
+        p.isAlive = False
+        readSide.cancel()
+
+    def _spawn(self, coroutine):
+        # Keep a reference so running tasks aren't garbage collected
+        task = self._loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _connectPeer(self, addr):
+        # Only the connect + handshake hold a dial slot, the peer is released to _runPeer once it checks out
+        async with self._dials:
+            writer = None
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*addr), CONNECT_TIMEOUT)
+                writer.write(self._handshakeMsg)
+                handshake = await self._readHandshake(reader)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                if DEBUG_MODE:
+                    print("asyncio engine failed to connect to", addr, e)
+                if writer is not None:
+                    writer.close()
+                return
+        await self._runPeer(reader, writer, addr, handshake, inbound=False)
+
+    async def _acceptPeer(self, reader, writer):
+        try:
+            handshake = await self._readHandshake(reader)
+            writer.write(self._handshakeMsg)
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            if DEBUG_MODE:
+                print("asyncio engine dropping inbound connection", e)
+            writer.close()
+            return
+        await self._runPeer(reader, writer, writer.get_extra_info('peername')[:2], handshake, inbound=True)
+
+    # Returns the peer's handshake once it's validated, raises OSError otherwise
+    async def _readHandshake(self, reader):
+        handshake = await asyncio.wait_for(reader.readexactly(68), HANDSHAKE_TIMEOUT)
+        if utils.checkHandshake(handshake, trackerRequestMsg.infoHash) is None:
+            raise OSError("Invalid handshake")
+        return handshake
+
+    # Returns (length, id, payload) like messageReader, or raises on a closed/broken connection
+    async def readMessage(self, reader):
+        length = int.from_bytes(await reader.readexactly(4), byteorder='big')
+        if length > MAX_MESSAGE_LENGTH:
+            raise Exception(f"Peer sent oversized message length prefix: {length}")
+        if length == 0:
+            # length 0, id -1, empty bytes (A Stay Alive Message)
+            return (0, -1, b'')
+        message = await reader.readexactly(length)
+        return (length, message[0], memoryview(message)[1:])
+
+    async def _runPeer(self, reader, writer, addr, handshake, inbound):
+        newPeer = None
+        housekeeping = None
+        writeLoop = None
+        try:
+            ip, port = addr
+            newPeer = peer()
+            newPeer.peerId = (ip, port, handshake[48:], BitArray(length=len(self._trackerInfo.pieces)), writer.get_extra_info('socket'), self._trackerInfo)
+            newPeer.fastExtension = utils.supportsFastExtension(handshake)
+            newPeer.extensionProtocol = utils.supportsExtensionProtocol(handshake)
+            newPeer.engine = self
+            self._writers[newPeer] = writer
+            self._wakeups[newPeer] = asyncio.Event()
+            writeLoop = self._spawn(self._writeLoop(newPeer, writer))
+            writeLoop.add_done_callback(functools.partial(self._writerDone, newPeer, asyncio.current_task()))
+            peer_obj_list.append(newPeer)
+
+            # Tell the peer what we already have
+            newPeer.send_initial_messages(always=inbound)
+            if DEBUG_MODE:
+                print("asyncio engine peer active -", addr)
+
+            housekeeping = self._spawn(self._housekeeping(newPeer))
+            while newPeer.isAlive:
+                message = await asyncio.wait_for(self.readMessage(reader), PEER_TIMEOUT)
+                newPeer.last_message_received = time.time()
+                newPeer.handle_message(message)
+                newPeer.queue_requests()
+                # Backpressure: don't read more while the peer isn't taking our writes
+                await writer.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if DEBUG_MODE:
+                print(f"exception for asyncio engine peer at: {addr}\n")
+                print(e)
+        finally:
+            if housekeeping is not None:
+                housekeeping.cancel()
+            if writeLoop is not None:
+                writeLoop.cancel()
+            if newPeer is not None:
+                self._writers.pop(newPeer, None)
+                self._wakeups.pop(newPeer, None)
+                newPeer.isAlive = False
+                newPeer.release_piece()
+                newPeer.leave_swarm()
+            writer.close()
+
+    # Interest, keep-alives and requests for anything that isn't triggered by a received message
+    async def _housekeeping(self, p):
+        lastKeepAlive = time.time()
+        while p.isAlive:
+            await asyncio.sleep(ENGINE_TICK)
+            p.determine_interested()
+            p.send_pex()
+            p.flush_haves()
+            p.check_requests()
+            now = time.time()
+            if now - lastKeepAlive > KEEP_ALIVE_INTERVAL:
+                lastKeepAlive = now
+                alive = messages()
+                alive.keepAlive()
+                p.send_message(alive)
+            p.queue_requests()
 
 class trackerReqMsg:
     def __init__(self):
@@ -822,6 +3075,7 @@ class trackerInfo:
         self._port = None
         self._encoding = None
         self._name = None
+        self._files = None
         self._length = None
         self._pieceLength = None
         self._pieces = None
@@ -835,6 +3089,15 @@ class trackerInfo:
     def length(self, value):
         self._length = value
 
+    # [(relative path, length), ...] for a multiple file torrent, None for a single file one
+    @property
+    def files(self):
+        return self._files
+
+    @files.setter
+    def files(self, value):
+        self._files = value
+
     @property
     def pieceLength(self):
         return self._pieceLength
@@ -898,14 +3161,41 @@ trackerResponseMsg = trackerRespMsg()
 trackerRespMutex = threading.Lock()
 # trackerRespMutex = threading.Lock()
 trackerReqMutex = threading.Lock()
-# piecesCollection = { pieceIndex : { blockIndex : data } } (make sure that requested blocks aren't overlapping data, please)
+# piecesCollection = { pieceIndex : pieceBuffer } (None once the piece is verified and written)
+# Buffers come from piecePool (see bufferPool), the budget is set from the '-m' option
+piecePool = bufferPool(256 * 2**20)
 piecesCollection = {}
 piecesCollectionMutex = threading.Lock()
+# piecesInProgress = { pieceIndex : pieceBuffer } for the pieces being downloaded (not yet verified and
+# written), so nobody has to go through piecesCollection's entries for every piece we have. Under piecesCollectionMutex
+piecesInProgress = {}
+# Pieces in progress with blocks nobody has requested yet (see peer._next_block), also under piecesCollectionMutex
+piecesClaimable = set()
+# pieceOwners = { pieceIndex : peer } the peer a piece in progress belongs to (see peer._next_block), also under piecesCollectionMutex
+pieceOwners = {}
 # piecesStatus = { pieceIndex : pieceAmountHaveBytes }
 piecesStatus = {}
 piecesStatusMutex = threading.Lock()
 
-workDeque = deque()
-workDequeMutex = threading.Lock()
-
-peer_obj_list = []
\ No newline at end of file
+# Pieces nobody is downloading yet, rarest first (see piecePicker)
+picker = piecePicker()
+
+# The output file, shared by the download and upload paths (see storage and utils.getStorage)
+outputStorage = None
+outputStorageMutex = threading.Lock()
+# Its diskWriter (see utils.getDiskWriter), fsyncEvery is set from the '-f' option
+pieceWriter = None
+fsyncEvery = 0
+# Serializes saves of the fast-resume file (see utils.saveResume)
+resumeMutex = threading.Lock()
+# Hashes completed pieces (see pieceVerifier), one worker per core
+pieceHasher = pieceVerifier(os.cpu_count() or 1)
+# Verified pieces read ahead for uploads (see pieceCache), the size is set from the '--cache' option
+uploadCache = pieceCache(64 * 2**20)
+# In-order output with '-s' (see pieceStream)
+pieceStreamer = None
+
+peer_obj_list = []
+
+# Addresses from the tracker and PEX (see peerPool)
+knownPeers = peerPool()
\ No newline at end of file
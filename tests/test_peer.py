@@ -0,0 +1,112 @@
+import os
+import sys
+import socket
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import objects
+from bitstring import BitArray
+
+PIECE_LENGTH = 4 * objects.BLOCK_SIZE
+NUM_PIECES = 4
+
+def makeTrackerInfo():
+    trackerInfo = objects.trackerInfo()
+    trackerInfo.name = "test.bin"
+    trackerInfo.length = NUM_PIECES * PIECE_LENGTH
+    trackerInfo.pieceLength = PIECE_LENGTH
+    trackerInfo.pieces = [b'x' * 20] * NUM_PIECES
+    return trackerInfo
+
+class snubTest(unittest.TestCase):
+    def setUp(self):
+        objects.piecesStatus.clear()
+        objects.piecesCollection.clear()
+        objects.piecesInProgress.clear()
+        objects.piecesClaimable.clear()
+        objects.picker.reset(NUM_PIECES, range(NUM_PIECES))
+        self.local, self.remote = socket.socketpair()
+        self.peer = objects.peer()
+        self.peer.peerId = ("127.0.0.1", 6881, b'p' * 20, BitArray(length=NUM_PIECES), self.local, makeTrackerInfo())
+        self.peer.peerBitfield = BitArray(bytes=b'\xff', length=NUM_PIECES)
+
+    def tearDown(self):
+        self.peer.drop_requests()
+        self.peer.release_piece()
+        self.peer.leave_swarm()
+        self.local.close()
+        self.remote.close()
+
+    # A peer that unchokes us long after connecting isn't snubbing us just because it sent nothing before
+    def testLateUnchokeIsNotSnubbed(self):
+        self.peer._last_block = time.time() - 2 * objects.SNUB_TIMEOUT
+        self.peer.peerChoked = False
+        self.peer.queue_requests()
+        self.assertTrue(self.peer._outstanding)
+        self.peer.check_requests()
+        self.assertFalse(self.peer.snubbed)
+
+    # Still snubbed once it really sends nothing for SNUB_TIMEOUT while we wait on it
+    def testSilentPeerIsSnubbed(self):
+        self.peer.peerChoked = False
+        self.peer.queue_requests()
+        self.peer._last_block = time.time() - 2 * objects.SNUB_TIMEOUT
+        self.peer.check_requests()
+        self.assertTrue(self.peer.snubbed)
+
+class pickerTest(unittest.TestCase):
+    # A peer with one piece behind far more than PICK_SCAN_LIMIT waiting ones it doesn't have still gets it
+    def testPickFindsPieceBehindScanLimit(self):
+        numPieces = 4 * objects.PICK_SCAN_LIMIT
+        picker = objects.piecePicker()
+        picker.reset(numPieces, range(numPieces))
+        everyone = BitArray(length=numPieces)
+        everyone.set(1)
+        picker.updatePeer(None, everyone)
+        bitfield = BitArray(length=numPieces)
+        bitfield[numPieces - 1] = 1
+        picker.updatePeer(None, bitfield)
+        calls = []
+        def canRequest(index):
+            calls.append(index)
+            return bitfield[index] == 1
+        self.assertTrue(picker.anyRequestable(canRequest, bitfield.findall([1])))
+        del calls[:]
+        self.assertEqual(picker.pick(canRequest, set(), True, bitfield.findall([1])), numPieces - 1)
+        self.assertLessEqual(len(calls), objects.PICK_SCAN_LIMIT + 1)
+        self.assertFalse(picker.anyRequestable(canRequest, bitfield.findall([1])))
+
+    # Endgame ends once a piece goes back to the picker (a peer dropped it) and starts again later
+    def testPutEndsEndgame(self):
+        picker = objects.piecePicker()
+        picker.reset(2, range(2))
+        self.assertTrue(picker.take(0))
+        self.assertTrue(picker.enterEndgame())
+        self.assertFalse(picker.enterEndgame())
+        self.assertTrue(picker.endgame)
+        picker.put(0)
+        self.assertFalse(picker.endgame)
+        self.assertTrue(picker.enterEndgame())
+
+class bufferPoolTest(unittest.TestCase):
+    # A short last piece that reuses a full size buffer is charged the whole buffer
+    def testReusedBufferChargesCapacity(self):
+        pool = objects.bufferPool(2 * PIECE_LENGTH)
+        first = pool.acquire(0, PIECE_LENGTH)
+        second = pool.acquire(1, PIECE_LENGTH)
+        pool.release(second)
+        short = PIECE_LENGTH - objects.BLOCK_SIZE
+        self.assertTrue(pool.hasRoom(short))
+        reused = pool.acquire(2, short)
+        self.assertIs(reused, second)
+        self.assertEqual(pool.bytesInUse, 2 * PIECE_LENGTH)
+        pool.release(reused)
+        pool.budget = 2 * PIECE_LENGTH - objects.BLOCK_SIZE
+        self.assertFalse(pool.hasRoom(short))
+        self.assertIsNone(pool.acquire(2, short))
+        pool.release(first)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,11 +16,15 @@ import random
 import selectors
 import traceback
 import random
+import os
+import multiprocessing
 from contextlib import redirect_stdout
 from alive_progress import alive_bar
 from bitstring import BitArray
 
 UDP_MAGIC_NUM = 0x41727101980
+# Biggest block we'll serve for a single REQUEST
+MAX_REQUEST_LENGTH = 2**17
 
 # Option Parsing
 def optParse():
@@ -36,6 +40,12 @@ def optParse():
     argParser.add_argument("-u", "--udp", required=False, action='store_true', help="(Optional) User may manually opt for support using a UDP-tracker protocol.")
     argParser.add_argument("-d", "--details", required=False, action='store_true', help="(Optional) Outputs real-time log of client behavior into console for details.")
     argParser.add_argument("-q", "--quit", required=False, action='store_true', help="(Optional) Informs the client to automatically disconnect from the tracker once complete download has finished; otherwise, it will remain part of the swarm as a seeder for peer downloads.")
+    argParser.add_argument("-m", "--memory", required=False, type=int, default=256, help="(Optional) Memory budget in MiB for pieces being downloaded. Once it's used up, pieces in progress are finished before new ones are started. If omitted, defaults to 256 MiB.")
+    argParser.add_argument("-f", "--fsync", required=False, type=fsyncPolicy, default="complete", help="(Optional) When downloaded data is fsync'd to disk: 'never', 'complete' (once the download is complete) or every N MiB written. If omitted, defaults to 'complete'.")
+    argParser.add_argument("--cache", required=False, type=int, default=64, help="(Optional) Size in MiB of the read cache for pieces we upload. If omitted, defaults to 64 MiB.")
+    argParser.add_argument("-r", "--recheck", required=False, action='store_true', help="(Optional) Hash the existing output file(s) against the torrent on startup (in parallel, one process per core) and only download the pieces that don't match. Use it for data copied from elsewhere or after an unclean shutdown.")
+    argParser.add_argument("-s", "--stream", required=False, metavar="TARGET", help="(Optional) Streaming mode: download the pieces just past the read position first and write the data in order, as soon as it's there, to TARGET: '-' for stdout, a path (e.g. a FIFO), 'unix:PATH' or 'tcp:HOST:PORT' for a local socket. The output file is still written.")
+    argParser.add_argument("-e", "--engine", required=False, choices=["thread", "selector", "asyncio"], default="thread", help="(Optional) Peer connection engine. 'thread' runs 3 threads per peer, 'selector' drives every peer from a single selector loop, 'asyncio' runs every peer as a coroutine on an asyncio event loop. If omitted, defaults to 'thread'.")
 
     args = argParser.parse_args()
 
@@ -51,12 +61,33 @@ def optParse():
     else:
         objects.DEBUG_MODE = False
 
+    # Streaming to stdout: everything we print goes to stderr instead
+    if args.stream == "-":
+        sys.stdout = sys.stderr
+
     if objects.DEBUG_MODE:
         print("\nOptions:\n\t- %s\n" % args)
         print("------------------------------------------------------------------")
 
     return args
 
+# Opens the '-s' target for binary writes: stdout, a local socket or a path (opening a FIFO waits for its reader)
+def openStream(target):
+    if target == "-":
+        return sys.__stdout__.buffer
+    if target.startswith("unix:"):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(target[len("unix:"):])
+    elif target.startswith("tcp:"):
+        host, port = target[len("tcp:"):].rsplit(":", 1)
+        sock = socket.create_connection((host, int(port)))
+    else:
+        return open(target, "wb")
+    # The socket is closed once the file is
+    output = sock.makefile("wb")
+    sock.close()
+    return output
+
 # Create socket based on UDP or TCP (HTTP)
 def establishSocket(udp, trackerInformation):
     if udp:
@@ -185,7 +216,8 @@ def getTrackerInfo(metaData, trackerInformation):
     trackerInformation.port = trackerPort
     trackerInformation.encoding = encoding
     trackerInformation.name = decoded[b'info'][b'name'].decode('utf-8')
-    trackerInformation.length = decoded[b'info'][b'length']
+    trackerInformation.files = getFileList(decoded[b'info'], encoding)
+    trackerInformation.length = getTotalLength(decoded[b'info'])
     trackerInformation.pieceLength = decoded[b'info'][b'piece length']
     trackerInformation.pieces = pieceHashList
     if b'private' not in decoded[b'info']:
@@ -200,6 +232,29 @@ def getTrackerInfo(metaData, trackerInformation):
         print("\t- trackerIP = %s\n\t- trackerPort = %d\n\t- trackerEncoding = %s\n\t- trackerName = %s\n\t- private = %d\n\t- length = %d\n\t- pieceLength = %d\n\t- pieces =" % (trackerInformation.ip, trackerInformation.port, trackerInformation.encoding, trackerInformation.name, trackerInformation.private, trackerInformation.length, trackerInformation.pieceLength), trackerInformation.pieces)
         print("------------------------------------------------------------------")
 
+# Total bytes of the torrent: 'length' in single file mode, the sum of every file's length in multiple file mode
+def getTotalLength(info):
+    if b'files' in info:
+        return sum(each[b'length'] for each in info[b'files'])
+    return info[b'length']
+
+# Multiple file mode: [(relative path, length), ...] in torrent order (the files are stored under the 'name' directory)
+# Single file mode: None
+def getFileList(info, encoding):
+    if b'files' not in info:
+        return None
+    files = []
+    for each in info[b'files']:
+        parts = [part.decode(encoding) for part in each[b'path']]
+        # Don't let a torrent write outside of its own directory
+        for part in parts:
+            if part in ('', '.', '..') or '/' in part or os.sep in part:
+                raise Exception("Invalid path in torrent: " + repr(parts))
+        if not parts:
+            raise Exception("Empty path in torrent")
+        files.append((os.path.join(*parts), each[b'length']))
+    return files
+
 # Extracting appropriate data from torrent file for appropriate tracker GET request
 def parseTorr(metaData, args, trackerRequestMsg):
     decoded = bencodepy.decode(metaData)
@@ -227,7 +282,7 @@ def parseTorr(metaData, args, trackerRequestMsg):
     downloaded = 0
 
     # Getting bytes left to download (Initial request: All data left to download)
-    left = decoded[b'info'][b'length']
+    left = getTotalLength(decoded[b'info'])
 
     # Getting number of peers that the client would like to receive from the tracker
     numwant = args.numWant
@@ -745,7 +800,8 @@ def pdcProgressBar(totalBytes, origStdout, trackerInformation, trackerSocket, ar
     with alive_bar(totalBytes, file=origStdout, title="Downloading " + trackerInformation.name + " (bytes):", manual=True) as bar:
         while objects.trackerRequestMsg.downloaded <= totalBytes:
             time.sleep(0.5)
-            bar(objects.trackerRequestMsg.downloaded / totalBytes)
+            bar.text = str(objects.piecePool) + ", " + str(objects.uploadCache)
+            bar((totalBytes - objects.trackerRequestMsg.left) / totalBytes)
 
         # Sending event=completed request to tracker
         if args.udp:
@@ -955,128 +1011,337 @@ def sendStopped(trackerInformation, trackerSocket, args):
                 print('Received empty periodic tracker response')
                 print("\n------------------------------------------------------------------")
 
-def verifyHash(totalPiece, pieceIndex, trackerInformation):
-    print("ATTEMPTING TO VERIFY HASH!!")
-    pieceHash = hashlib.sha1(totalPiece).digest()
-
-    print("Expected Hash -", trackerInformation.pieces[pieceIndex])
-    print("Calculated Hash -", pieceHash)
-    # Need to find which piece hash to compare to
-    if pieceHash == trackerInformation.pieces[pieceIndex]:
-        if objects.DEBUG_MODE:
-            print("SHA-1 Hash is correct!")
-        return True
-    else:
-        return False
-
-
-def combineBlocks(pieceIndex):
-    print("ATTEMPTING TO COMBINE BLOCKS")
-    # Combining blocks from smallest-to-largest index
-    totalPiece = b''
-    for block in sorted(objects.piecesCollection[pieceIndex].keys()):
-        # print("Block Index -", block, " Block data -", objects.piecesCollection[pieceIndex][block])
-        totalPiece += objects.piecesCollection[pieceIndex][block]
-
-    # print("Total Block -", totalPiece)
-
-    return totalPiece
-
-def writePieceToFile(pieceIndex, totalPiece, trackerInformation):
-    with open(trackerInformation.name, 'a+b') as file:
-        # Move cursor to correct position in file & write
-        file.seek(pieceIndex*trackerInformation.pieceLength)
-        file.write(totalPiece)
-        if objects.DEBUG_MODE:
-            print("Successfully wrote piece to file!")
-
-# If gotten an entire piece, verify then write to file on disk at 'x'
+# Checks a complete piece's hash. Needs piecesStatusMutex, piecesCollectionMutex and trackerReqMutex.
+# A piece that came in order is already hashed block by block (see objects.pieceBuffer) and is checked right
+# here, otherwise the rest of it goes to the hashing pool (see objects.pieceVerifier) and pieceVerified applies the result.
+# Returns True if it was checked here and thrown away, the caller gives it back to the picker once the mutexes are released
 def verifyWholePiece(pieceIndex, trackerInformation):
     
-    totalPiece = combineBlocks(pieceIndex)
-    matchingHash = verifyHash(totalPiece, pieceIndex, trackerInformation)
-    if matchingHash:
-        # Write to file in disk at index 'x'
-        writePieceToFile(pieceIndex, totalPiece, trackerInformation)
-        have_msg = objects.messages()
-        have_msg.have(struct.pack('>I', pieceIndex))
-        for peer in objects.peer_obj_list:
-            if peer.isAlive:
-                peer.send_message(have_msg)
-
-        objects.piecesCollection[pieceIndex] = None
-        objects.piecesStatus[pieceIndex] = None # Should implement behavior such that if 'None' is encountered, we already have correct full piece (deny any data from this piece)
-    else:
-        # Dump piece, and start from empty again
-        # Changing global object data
-        objects.trackerRequestMsg.downloaded -= objects.piecesStatus[pieceIndex]
-        objects.trackerRequestMsg.left += objects.piecesStatus[pieceIndex]
-
-        # Reset containers for piece
-        # Finn's change: Im just gonna pop the index since setting it to 
-        # {} and 0 is confusing as to whether we have data on a block/piece or not
-
-        # objects.piecesCollection[pieceIndex] = {}
-        # objects.piecesStatus[pieceIndex] = 0
-        objects.piecesCollection.pop(pieceIndex)
-        objects.piecesStatus.pop(pieceIndex)
-
-        # Production: Notify User why progress bar decreased
-        print("Incorrect Piece Data due to Non-Matching SHA1 Hash: Resetting Piece @%d (- %d bytes)" % (pieceIndex, len(totalPiece)))
-
-# Parses peer's piece msg and adds block to respective piece in pieces dictionary
+    # View of the piece buffer: hashed and written without joining/copying blocks
+    buffer = objects.piecesCollection[pieceIndex]
+    totalPiece = buffer.data
+    if buffer.hashed == buffer.length:
+        if buffer.hasher.digest() == trackerInformation.pieces[pieceIndex]:
+            pieceMatched(pieceIndex, trackerInformation, totalPiece)
+            return False
+        pieceMismatched(pieceIndex, len(totalPiece))
+        return True
+    objects.pieceHasher.submit(pieceIndex, buffer.hasher, totalPiece[buffer.hashed:], trackerInformation.pieces[pieceIndex],
+                               lambda ok: pieceVerified(pieceIndex, trackerInformation, totalPiece, ok))
+    return False
+
+# Verifier callback (runs on a hashing thread)
+def pieceVerified(pieceIndex, trackerInformation, totalPiece, ok):
+    if ok:
+        # (nothing else touches a complete piece, no locks needed)
+        pieceMatched(pieceIndex, trackerInformation, totalPiece)
+        return
+    with objects.piecesStatusMutex:
+        with objects.piecesCollectionMutex:
+            with objects.trackerReqMutex:
+                pieceMismatched(pieceIndex, len(totalPiece))
+    objects.picker.put(pieceIndex)
+
+def pieceMatched(pieceIndex, trackerInformation, totalPiece):
+    if objects.DEBUG_MODE:
+        print("SHA-1 Hash is correct! Piece @%d" % pieceIndex)
+    # Written in the background, pieceWritten finishes the job
+    getDiskWriter(trackerInformation).submit(pieceIndex*trackerInformation.pieceLength, totalPiece,
+                                             lambda ok: pieceWritten(pieceIndex, trackerInformation, ok))
+
+# Dump piece, and start from empty again. Needs piecesStatusMutex, piecesCollectionMutex and trackerReqMutex.
+# The peer that downloaded it may have moved on, so the caller puts it back in the picker after releasing them
+# (the picker's lock is never taken while holding the piece mutexes)
+def pieceMismatched(pieceIndex, pieceLength):
+    resetPiece(pieceIndex)
+
+    # Production: Notify User why progress bar decreased
+    print("Incorrect Piece Data due to Non-Matching SHA1 Hash: Resetting Piece @%d (- %d bytes)" % (pieceIndex, pieceLength))
+
+# Disk writer callback (runs on the writer thread)
+def pieceWritten(pieceIndex, trackerInformation, ok):
+    with objects.piecesStatusMutex:
+        with objects.piecesCollectionMutex:
+            with objects.trackerReqMutex:
+                if not ok:
+                    resetPiece(pieceIndex)
+                else:
+                    if objects.DEBUG_MODE:
+                        print("Successfully wrote piece to file!")
+                    objects.piecePool.release(objects.piecesCollection[pieceIndex])
+                    objects.piecesCollection[pieceIndex] = None
+                    objects.piecesInProgress.pop(pieceIndex, None)
+                    objects.piecesClaimable.discard(pieceIndex)
+                    objects.pieceOwners.pop(pieceIndex, None)
+                    objects.piecesStatus[pieceIndex] = None # Should implement behavior such that if 'None' is encountered, we already have correct full piece (deny any data from this piece)
+    if not ok:
+        # Download it again (back in the picker once the piece mutexes are released)
+        objects.picker.put(pieceIndex)
+        return
+
+    # Only now can peers request it from us (HAVEs are batched per peer, see objects.peer.queue_have)
+    for peer in objects.peer_obj_list:
+        if peer.isAlive:
+            peer.queue_have(pieceIndex)
+    if objects.pieceStreamer is not None:
+        objects.pieceStreamer.pieceReady()
+
+# Throws away a piece's data (failed hash or write). Needs piecesStatusMutex, piecesCollectionMutex and trackerReqMutex
+def resetPiece(pieceIndex):
+    # Changing global object data
+    objects.trackerRequestMsg.downloaded -= objects.piecesStatus[pieceIndex]
+    objects.trackerRequestMsg.left += objects.piecesStatus[pieceIndex]
+
+    # Reset containers for piece
+    # Finn's change: Im just gonna pop the index since setting it to 
+    # {} and 0 is confusing as to whether we have data on a block/piece or not
+    # The buffer goes back to the pool, the piece gets a fresh one when it's picked again
+    objects.piecePool.release(objects.piecesCollection.pop(pieceIndex))
+    objects.piecesInProgress.pop(pieceIndex, None)
+    objects.piecesClaimable.discard(pieceIndex)
+    objects.pieceOwners.pop(pieceIndex, None)
+    objects.piecesStatus.pop(pieceIndex)
+
+# The output file (opened and preallocated on first use), shared by every piece write and upload.
+# sendfile is always given an explicit offset, so every peer can share its file object
+def getStorage(trackerInformation):
+    with objects.outputStorageMutex:
+        if objects.outputStorage is None:
+            objects.outputStorage = objects.storage(trackerInformation.name, trackerInformation.length, trackerInformation.files)
+    return objects.outputStorage
+
+def getDiskWriter(trackerInformation):
+    storage = getStorage(trackerInformation)
+    with objects.outputStorageMutex:
+        if objects.pieceWriter is None:
+            # Every piece buffer piecePool can hand out (the budget's worth, plus the one that's always allowed
+            # and a shorter last piece) can wait for the disk, so submit() never blocks
+            maxPending = objects.piecePool.budget // trackerInformation.pieceLength + 2
+            objects.pieceWriter = objects.diskWriter(storage, objects.fsyncEvery, maxPending)
+    return objects.pieceWriter
+
+# Fast-resume file, next to the download: '<name>.resume', a bencoded dict with the info hash, the bitfield of
+# pieces that are verified and on disk, and the size and mtime of every file. Saving never fsyncs the download
+# itself: it follows '-f', pieces the disk writer hasn't fsync'd yet aren't recorded (with '-f never' every
+# written piece is, nothing is ever fsync'd).
+# On startup pieces are trusted if every file they touch still has the recorded size and mtime. Pieces that
+# touch a file that changed since (we crashed after the last save, or something else wrote to it) are re-hashed,
+# so pieces written after the last save aren't lost either. Pieces that were in progress are never on disk
+# (see objects.pieceBuffer), so there is nothing to keep for them
+def getResumePath(trackerInformation):
+    return trackerInformation.name + ".resume"
+
+def saveResume(trackerInformation):
+    with objects.resumeMutex:
+        storage = getStorage(trackerInformation)
+        with objects.piecesStatusMutex:
+            bitfield = getOwnBitfield(trackerInformation)
+        # (after the bitfield: a piece is in unsynced() before it's marked as ours)
+        unsynced = objects.pieceWriter.unsynced() if objects.pieceWriter is not None else ()
+        for offset in unsynced:
+            bitfield.set(False, offset // trackerInformation.pieceLength)
+        state = {b'info hash': objects.trackerRequestMsg.infoHash,
+                 b'pieces': bitfield.tobytes(),
+                 b'files': [[size, mtime] for size, mtime in storage.stat()]}
+        path = getResumePath(trackerInformation)
+        with open(path + ".tmp", "wb") as resumeFile:
+            resumeFile.write(bencodepy.encode(state))
+            resumeFile.flush()
+            os.fsync(resumeFile.fileno())
+        os.replace(path + ".tmp", path)
+
+def pdcResumeSave(trackerInformation):
+    while True:
+        time.sleep(objects.RESUME_INTERVAL)
+        try:
+            saveResume(trackerInformation)
+        except OSError as e:
+            print("Could not save resume file:", e)
+
+# Reads the resume file and marks the pieces we already have (call before any peer connects).
+# Returns the number of pieces found
+def loadResume(trackerInformation):
+    try:
+        with open(getResumePath(trackerInformation), "rb") as resumeFile:
+            state = bencodepy.decode(resumeFile.read())
+        if state[b'info hash'] != objects.trackerRequestMsg.infoHash:
+            print("Resume file is for another torrent, ignoring it")
+            return 0
+        bitfield = BitArray(bytes=state[b'pieces'], length=len(trackerInformation.pieces))
+        recorded = [tuple(each) for each in state[b'files']]
+    except FileNotFoundError:
+        return 0
+    except (OSError, KeyError, ValueError, TypeError, bencodepy.BencodeDecodeError) as e:
+        print("Resume file is unreadable, ignoring it:", e)
+        return 0
+
+    storage = getStorage(trackerInformation)
+    current = storage.stat()
+    if len(recorded) != len(current):
+        print("Resume file doesn't match the torrent's files, ignoring it")
+        return 0
+    # A file whose size or mtime differs from the checkpoint was modified after it (we crashed after the
+    # last save, or something else wrote to it): none of its recorded pieces are trusted, every piece
+    # touching it is re-hashed
+    changed = set(i for i in range(len(current)) if current[i] != recorded[i])
+
+    have = []
+    recheck = []
+    for pieceIndex in range(len(trackerInformation.pieces)):
+        trusted = True
+        if changed:
+            pieceLength = getPieceLength(pieceIndex, trackerInformation)
+            for fileIndex, fileOffset, size in storage.segments(pieceIndex * trackerInformation.pieceLength, pieceLength):
+                if fileIndex in changed:
+                    trusted = False
+                    break
+        if not trusted:
+            recheck.append(pieceIndex)
+        elif bitfield[pieceIndex]:
+            have.append(pieceIndex)
+
+    have.extend(recheckPieces(trackerInformation, recheck))
+    for pieceIndex in have:
+        markPieceHave(pieceIndex, trackerInformation)
+    print("Resumed %d/%d pieces (%d re-hashed)" % (len(have), len(trackerInformation.pieces), len(recheck)))
+    return len(have)
+
+# '-r' option: hash every piece of the existing output file(s), mark the good ones as ours and save the resume file
+def recheckAll(trackerInformation):
+    have = recheckPieces(trackerInformation, range(len(trackerInformation.pieces)))
+    for pieceIndex in have:
+        markPieceHave(pieceIndex, trackerInformation)
+    saveResume(trackerInformation)
+    print("Recheck: %d/%d pieces verified" % (len(have), len(trackerInformation.pieces)))
+    return len(have)
+
+# Hashes pieces straight from the output file(s) on a multiprocessing pool (one process per core, SHA-1 isn't
+# held back by the GIL or a single core). Consecutive pieces are handed out together in runs of about
+# RECHECK_CHUNK bytes that the worker reads with large sequential preads. Returns the good piece indices
+def recheckPieces(trackerInformation, indices):
+    indices = sorted(indices)
+    if not indices:
+        return []
+    # (smaller runs when there are too few pieces to keep every process busy)
+    workers = os.cpu_count() or 1
+    piecesPerRun = max(1, min(objects.RECHECK_CHUNK // trackerInformation.pieceLength, len(indices) // (workers * 4)))
+    runs = []
+    for pieceIndex in indices:
+        if runs and runs[-1][1] == pieceIndex and runs[-1][1] - runs[-1][0] < piecesPerRun:
+            runs[-1][1] += 1
+        else:
+            runs.append([pieceIndex, pieceIndex + 1])
+
+    have = []
+    checkedBytes = 0
+    startTime = time.time()
+    workers = min(workers, len(runs))
+    with multiprocessing.Pool(workers, initializer=recheckInit,
+                              initargs=(trackerInformation.name, trackerInformation.length, trackerInformation.files,
+                                        trackerInformation.pieceLength, trackerInformation.pieces)) as pool:
+        for first, good, size in pool.imap_unordered(recheckRun, runs):
+            have.extend(first + i for i in range(len(good)) if good[i])
+            checkedBytes += size
+    elapsed = max(time.time() - startTime, 1e-6)
+    print("Re-hashed %d pieces (%.1f MiB) in %.2fs: %.1f MiB/s on %d processes" % (len(indices), checkedBytes / 2**20, elapsed, checkedBytes / 2**20 / elapsed, workers))
+    return have
+
+# Recheck worker state (one per process, see recheckPieces)
+recheckStorage = None
+recheckInfo = None
+
+def recheckInit(name, length, files, pieceLength, pieces):
+    global recheckStorage, recheckInfo
+    # The main process already created and preallocated the files
+    recheckStorage = objects.storage(name, length, files, preallocate=False)
+    recheckInfo = (length, pieceLength, pieces)
+
+# Worker: hashes pieces first..last-1, returns (first, bytes with 1 for every good piece, bytes read)
+def recheckRun(run):
+    first, last = run
+    length, pieceLength, pieces = recheckInfo
+    start = first * pieceLength
+    end = min(last * pieceLength, length)
+    data = memoryview(recheckStorage.read(start, end - start))
+    good = bytearray(last - first)
+    for pieceIndex in range(first, last):
+        offset = (pieceIndex - first) * pieceLength
+        good[pieceIndex - first] = hashlib.sha1(data[offset:offset + pieceLength]).digest() == pieces[pieceIndex]
+    return first, bytes(good), end - start
+
+# A piece that is already verified and on disk (from the resume file)
+def markPieceHave(pieceIndex, trackerInformation):
+    with objects.piecesStatusMutex:
+        with objects.piecesCollectionMutex:
+            with objects.trackerReqMutex:
+                objects.piecesCollection[pieceIndex] = None
+                objects.piecesStatus[pieceIndex] = None
+                objects.trackerRequestMsg.left -= getPieceLength(pieceIndex, trackerInformation)
+
+# '-f' option: 'never', 'complete' or a number of MiB
+def fsyncPolicy(value):
+    if value == "never":
+        return None
+    if value == "complete":
+        return 0
+    try:
+        mib = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be 'never', 'complete' or a number of MiB")
+    if mib <= 0:
+        raise argparse.ArgumentTypeError("must be a positive number of MiB")
+    return mib * 2**20
+
+# Length of a piece (only the last piece can be shorter than trackerInformation.pieceLength)
+def getPieceLength(pieceIndex, trackerInformation):
+    return min(trackerInformation.pieceLength, trackerInformation.length - pieceIndex * trackerInformation.pieceLength)
+
+# Parses peer's piece msg and copies the block into its piece's buffer.
+# Returns True if it completed the piece and the piece failed its hash check (see verifyWholePiece)
 def addBlockToPiece(pieceIndex, blockIndex, blockData, trackerInformation, blockLen):
     
     # Note: the 'piecesCollection' storage data structure is complex, look at bottom of objects.py for details 
-    if pieceIndex in objects.piecesCollection and pieceIndex in objects.piecesStatus:
-        # Checking if recved block is already part of complete downloaded piece
-        if objects.piecesStatus[pieceIndex] == None:
+    if pieceIndex >= len(trackerInformation.pieces):
+        return
+    if objects.piecesStatus.get(pieceIndex, 0) is None:
+        if objects.DEBUG_MODE:
+            print("Already have complete downloaded piece @%d index. Dumping..." % pieceIndex)
+        return
+    if pieceIndex not in objects.piecesCollection:
+        buffer = objects.piecePool.acquire(pieceIndex, getPieceLength(pieceIndex, trackerInformation))
+        if buffer is None:
             if objects.DEBUG_MODE:
-                print("Already have complete downloaded piece @%d index. Dumping..." % pieceIndex)
-        else:
-            # Checking if we already have recved block in piece 
-            if (objects.piecesCollection[pieceIndex] is None) or blockIndex in objects.piecesCollection[pieceIndex]:
-                if objects.DEBUG_MODE:
-                    print("Already have block of data @%d index, piece index @%d. Dumping..." % (blockIndex, pieceIndex))
-            else:
-                objects.piecesCollection[pieceIndex][blockIndex] = blockData
-                objects.piecesStatus[pieceIndex] += blockLen
-
-                # Changing global object data
-                objects.trackerRequestMsg.downloaded += blockLen
-                objects.trackerRequestMsg.left -= blockLen
-    else:
-        objects.piecesCollection[pieceIndex] = {blockIndex:blockData}
-        objects.piecesStatus[pieceIndex] = blockLen
-
-        # Changing global object data
-        objects.trackerRequestMsg.downloaded += blockLen
-        objects.trackerRequestMsg.left -= blockLen
-
-    # Commenting this out in case I'm wrong. But don't you only need to check if 
-    # objects.piecesStatus[pieceIndex] == trackerInformation.pieceLength to verifyWholePiece
-
-    # This is for edge case of last piece (may have smaller piece length than others)
-    isLastPiece = False
-    maxPieceIndex = max(objects.piecesCollection)  
-    if trackerInformation.length - (maxPieceIndex * trackerInformation.pieceLength) < trackerInformation.pieceLength:
-        isLastPiece = True
-        lastPieceLen = trackerInformation.length - (maxPieceIndex * trackerInformation.pieceLength)
-
-    # Checking if gotten entire piece yet
-    if isLastPiece:
-        print("piecesStatus total bytes downloaded -", objects.piecesStatus[pieceIndex], "vs last pieceLength -", lastPieceLen)
-        if objects.piecesStatus[pieceIndex] == lastPieceLen:
-            verifyWholePiece(pieceIndex, trackerInformation)
-    else:
-        print("piecesStatus total bytes downloaded -", objects.piecesStatus[pieceIndex], "vs trackerInformation.pieceLength -", trackerInformation.pieceLength)
-        if objects.piecesStatus[pieceIndex] == trackerInformation.pieceLength:
-            verifyWholePiece(pieceIndex, trackerInformation)
-
-    # print("piecesStatus total bytes downloaded -", objects.piecesStatus[pieceIndex], "vs trackerInformation.pieceLength -", trackerInformation.pieceLength)
-    # if objects.piecesStatus[pieceIndex] == trackerInformation.pieceLength:
-    #     print("MATCHING TOTAL PIECE LENGTH, NOW VERIFYING HASH & COMBINING BLOCKS")
-    #     verifyWholePiece(pieceIndex, trackerInformation)
+                print("No piece buffer left for unrequested piece @%d index. Dumping..." % pieceIndex)
+            return
+        objects.piecesCollection[pieceIndex] = buffer
+        objects.piecesInProgress[pieceIndex] = buffer
+        objects.piecesClaimable.add(pieceIndex)
+        objects.piecesStatus[pieceIndex] = 0
+
+    # Checking if we already have recved block in piece 
+    if not objects.piecesCollection[pieceIndex].addBlock(blockIndex, blockData):
+        if objects.DEBUG_MODE:
+            print("Already have (or unexpected) block of data @%d index, piece index @%d. Dumping..." % (blockIndex, pieceIndex))
+        return
+    if objects.piecesCollection[pieceIndex].unclaimed == 0:
+        objects.piecesClaimable.discard(pieceIndex)
+    objects.piecesStatus[pieceIndex] += blockLen
+
+    # Changing global object data
+    objects.trackerRequestMsg.downloaded += blockLen
+    objects.trackerRequestMsg.left -= blockLen
+
+    # Checking if gotten entire piece yet (O(1), the buffer counts its blocks)
+    if objects.piecesCollection[pieceIndex].complete:
+        return verifyWholePiece(pieceIndex, trackerInformation)
+    return False
+
+# Endgame: a block arrived from 'peer', send CANCEL to every other peer we asked for the same block
+def cancelDuplicateRequests(pieceIndex, blockIndex, blockLen, peer):
+    for other in list(objects.peer_obj_list):
+        if other is not peer and other.isAlive and other.cancel_request(pieceIndex, blockIndex, blockLen):
+            if objects.DEBUG_MODE:
+                print("Cancelled duplicate request for piece @%d block @%d -" % (pieceIndex, blockIndex), other.peerAddr)
 
 # https://stackoverflow.com/questions/65250690/is-there-a-provably-optimal-block-piece-size-for-torrents-and-individual-file
 # Block request lengths decided by client (strategy ig), just pls makes sure they don't overlap
@@ -1095,7 +1360,7 @@ def parsePeerMsg(peerResp, trackerInformation, peer):
                 case objects.CHOKE:
                     if objects.DEBUG_MODE:
                         print("Received peerMsg CHOKE -", peer.peerAddr)
-                    peer.peerChoked = True
+                    peer.got_choked()
 
                 case objects.UNCHOKE:
                     if objects.DEBUG_MODE:
@@ -1128,7 +1393,7 @@ def parsePeerMsg(peerResp, trackerInformation, peer):
                     if objects.DEBUG_MODE:
                         print("Received peerMsg BITFIELD -", peer.peerAddr)
 
-                    bitfield = BitArray(bytes=peerResp[2])
+                    bitfield = BitArray(bytes=bytes(peerResp[2]))
 
                     peer.peerBitfield = bitfield
 
@@ -1143,19 +1408,43 @@ def parsePeerMsg(peerResp, trackerInformation, peer):
                     blockIndex = msgBody[1]
                     blockLength = msgBody[2]
 
-                    with open(trackerInformation.name, 'rb') as file:
-                        # Move cursor to correct position in file & write
-                        file.seek(pieceIndex*trackerInformation.pieceLength + blockIndex)
-                        data = file.read(blockLength)
-
-                    if not data or len(data) < blockLength:
+                    # Only serve (at most 128KB) blocks of pieces we have verified
+                    if (pieceIndex >= len(trackerInformation.pieces) or objects.piecesStatus.get(pieceIndex, 0) is not None
+                            or blockLength > MAX_REQUEST_LENGTH or blockIndex + blockLength > getPieceLength(pieceIndex, trackerInformation)):
                         if objects.DEBUG_MODE:
                             print(f"invalid request. Piece index: {pieceIndex}. Block index: {blockIndex}. Block Length: {blockLength}")
+                        if peer.fastExtension:
+                            rejectMsg = objects.messages()
+                            rejectMsg.rejectRequest((pieceIndex, blockIndex, blockLength))
+                            peer.send_message(rejectMsg)
+                    elif peer.fastExtension and peer.amChoking and pieceIndex not in peer.allowedFastOut:
+                        # Fast Extension peers get an explicit answer to requests sent while we choke them
+                        rejectMsg = objects.messages()
+                        rejectMsg.rejectRequest((pieceIndex, blockIndex, blockLength))
+                        peer.send_message(rejectMsg)
                     else:
                         pieceMsg = objects.messages()
-                        pieceMsg.piece((len(data), pieceIndex, blockIndex, data))
-                        peer.send_message(pieceMsg)
-                    
+                        cachedPiece = objects.uploadCache.get(pieceIndex)
+                        if cachedPiece is not None:
+                            pieceMsg.pieceFromBuffer((blockLength, pieceIndex, blockIndex, memoryview(cachedPiece)[blockIndex:blockIndex + blockLength]))
+                        else:
+                            # The rest of the piece is probably next, read it all ahead
+                            if blockIndex == 0:
+                                objects.uploadCache.readAhead(getStorage(trackerInformation), pieceIndex, pieceIndex*trackerInformation.pieceLength,
+                                                              getPieceLength(pieceIndex, trackerInformation))
+                            # Header goes out as bytes, the block itself is sendfile'd straight from the output file
+                            # (a block that crosses a file boundary is read instead, sendfile takes one file)
+                            storage = getStorage(trackerInformation)
+                            blockOffset = pieceIndex*trackerInformation.pieceLength + blockIndex
+                            location = storage.locate(blockOffset, blockLength)
+                            if location is not None:
+                                pieceMsg.pieceFromFile((blockLength, pieceIndex, blockIndex, location[0], location[1]))
+                            else:
+                                pieceMsg.pieceFromBuffer((blockLength, pieceIndex, blockIndex, storage.read(blockOffset, blockLength)))
+                        if peer.send_message(pieceMsg):
+                            with objects.trackerReqMutex:
+                                objects.trackerRequestMsg.uploaded += blockLength
+
 
                 case objects.PIECE:
                     if objects.DEBUG_MODE:
@@ -1167,6 +1456,7 @@ def parsePeerMsg(peerResp, trackerInformation, peer):
                     pieceIndex = msgBody[0]
                     # Block index = offset within the piece (by bytes)
                     blockIndex = msgBody[1]
+                    # View into the receive buffer, addBlockToPiece copies it straight into the piece buffer
                     blockData = peerResp[2][8:]
                     blockLen = msgLen - 9
 
@@ -1180,7 +1470,11 @@ def parsePeerMsg(peerResp, trackerInformation, peer):
                     with objects.piecesStatusMutex:
                         with objects.piecesCollectionMutex:
                             with objects.trackerReqMutex:
-                                addBlockToPiece(pieceIndex, blockIndex, blockData, trackerInformation, blockLen)
+                                failed = addBlockToPiece(pieceIndex, blockIndex, blockData, trackerInformation, blockLen)
+                    if failed:
+                        objects.picker.put(pieceIndex)
+                    if objects.picker.endgame:
+                        cancelDuplicateRequests(pieceIndex, blockIndex, blockLen, peer)
 
                 case objects.CANCEL:
                     if objects.DEBUG_MODE:
@@ -1192,12 +1486,55 @@ def parsePeerMsg(peerResp, trackerInformation, peer):
                     blockIndex = msgBody[1]
                     blockLength = msgBody[2]
 
-                    peer.cancelled_request = (pieceIndex, blockIndex, blockLength)
+                    # Drop the PIECE response if it's still queued (and don't count it as uploaded)
+                    if peer.cancel_piece(pieceIndex, blockIndex, blockLength):
+                        with objects.trackerReqMutex:
+                            objects.trackerRequestMsg.uploaded -= blockLength
+                        # With the Fast Extension every request gets either its PIECE or a REJECT
+                        if peer.fastExtension:
+                            rejectMsg = objects.messages()
+                            rejectMsg.rejectRequest((pieceIndex, blockIndex, blockLength))
+                            peer.send_message(rejectMsg)
 
                 case objects.PORT: 
                     if objects.DEBUG_MODE:
                         print("Received peerMsg PORT -", peer.peerAddr)
                     # Bro idek if this'll be used b/c it requires a local routing table (yuck!)
+
+                case objects.EXTENDED if peer.extensionProtocol:
+                    if objects.DEBUG_MODE:
+                        print("Received peerMsg EXTENDED -", peer.peerAddr)
+                    parseExtendedMsg(peerResp[2], peer)
+
+                case objects.SUGGEST_PIECE if peer.fastExtension:
+                    if objects.DEBUG_MODE:
+                        print("Received peerMsg SUGGEST PIECE -", peer.peerAddr)
+                    pieceIndex = struct.unpack('>I', peerResp[2])[0]
+                    peer.suggest_piece(pieceIndex)
+
+                case objects.HAVE_ALL if peer.fastExtension:
+                    if objects.DEBUG_MODE:
+                        print("Received peerMsg HAVE ALL -", peer.peerAddr)
+                    bitfield = BitArray(length=len(trackerInformation.pieces))
+                    bitfield.set(True)
+                    peer.peerBitfield = bitfield
+
+                case objects.HAVE_NONE if peer.fastExtension:
+                    if objects.DEBUG_MODE:
+                        print("Received peerMsg HAVE NONE -", peer.peerAddr)
+                    peer.peerBitfield = BitArray(length=len(trackerInformation.pieces))
+
+                case objects.REJECT_REQUEST if peer.fastExtension:
+                    if objects.DEBUG_MODE:
+                        print("Received peerMsg REJECT REQUEST -", peer.peerAddr)
+                    pieceIndex, blockIndex, blockLength = struct.unpack('>III', peerResp[2])
+                    peer.request_rejected(pieceIndex, blockIndex, blockLength)
+
+                case objects.ALLOWED_FAST if peer.fastExtension:
+                    if objects.DEBUG_MODE:
+                        print("Received peerMsg ALLOWED FAST -", peer.peerAddr)
+                    pieceIndex = struct.unpack('>I', peerResp[2])[0]
+                    peer.allow_fast(pieceIndex)
         else:
             # keep-alive msg
             # Do stuff
@@ -1223,11 +1560,95 @@ def parsePeerMsg(peerResp, trackerInformation, peer):
     # Send whatever you need to back to the peer here
     # connection.send(SOMETHING)
 
+# Returns the peer id from a 68 byte handshake, or None if it isn't a valid handshake for our torrent
+def checkHandshake(handshake, infoHash):
+    if len(handshake) != 68 or handshake[1:20] != "BitTorrent protocol".encode('utf-8'):
+        return None
+    if handshake[1+19+8:1+19+28] != infoHash:
+        return None
+    # Connected to ourselves (our own address can come back to us through PEX)
+    if handshake[48:] == objects.trackerRequestMsg.peerId.encode():
+        return None
+    return handshake[48:]
+
+# True if the handshake's reserved bytes announce the Fast Extension (BEP 6)
+def supportsFastExtension(handshake):
+    return (handshake[20 + 7] & objects.FAST_EXTENSION_BIT) != 0
+
+# True if the handshake's reserved bytes announce the Extension Protocol (BEP 10)
+def supportsExtensionProtocol(handshake):
+    return (handshake[20 + 5] & objects.EXTENSION_PROTOCOL_BIT) != 0
+
+# Bencoded extended handshake: the extensions we understand (only ut_pex) and our listening port
+def getExtendedHandshake():
+    return bencodepy.encode({b'm': {b'ut_pex': objects.UT_PEX_ID}, b'p': objects.trackerRequestMsg.port, b'v': b'bt-client'})
+
+# Bencoded ut_pex message from lists of (ip, port) (IPv4 only, in compact form)
+def getPexMessage(added, dropped):
+    return bencodepy.encode({
+        b'added': b''.join(socket.inet_aton(ip) + struct.pack('>H', port) for ip, port in added),
+        b'added.f': bytes(len(added)),
+        b'dropped': b''.join(socket.inet_aton(ip) + struct.pack('>H', port) for ip, port in dropped),
+    })
+
+# Handles an extended (BEP 10) message: the extended handshake or a ut_pex message
+def parseExtendedMsg(payload, peer):
+    extendedId = payload[0]
+    body = bencodepy.decode(bytes(payload[1:]))
+    if extendedId == objects.EXTENDED_HANDSHAKE:
+        extensions = body.get(b'm', {})
+        listenPort = body.get(b'p')
+        peer.extended_handshake(extensions, listenPort if isinstance(listenPort, int) else None)
+    elif extendedId == objects.UT_PEX_ID:
+        # Every address we haven't seen yet gets dialed (peerPool deduplicates)
+        added = body.get(b'added', b'')
+        for i in range(0, min(len(added), 6 * objects.MAX_PEX_PEERS) - 5, 6):
+            ip = socket.inet_ntoa(added[i:i + 4])
+            port = struct.unpack('>H', added[i + 4:i + 6])[0]
+            if port != 0:
+                objects.knownPeers.add((ip, port))
+
+# BEP 6 canonical allowed fast set: derived from the peer's /24 and the info hash, so reconnecting
+# from the same network doesn't get a peer a fresh set
+def getAllowedFastSet(ip, infoHash, numPieces):
+    allowed = []
+    try:
+        x = bytes(socket.inet_aton(ip)[:3]) + b'\x00' + infoHash
+    except OSError:
+        # Only defined for IPv4
+        return allowed
+    k = min(objects.ALLOWED_FAST_COUNT, numPieces)
+    while len(allowed) < k:
+        x = hashlib.sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(allowed) == k:
+                break
+            index = int.from_bytes(x[i:i + 4], byteorder='big') % numPieces
+            if index not in allowed:
+                allowed.append(index)
+    return allowed
+
+# BitArray of the pieces we have completely downloaded and verified
+def getOwnBitfield(trackerInformation):
+    # Get a BitArray with length == num of pieces
+    bitfield_array = BitArray(length=len(trackerInformation.pieces))
+
+    # Search for any piece thats completed (where data == None)
+    for i, data in list(objects.piecesStatus.items()):
+        if data == None:
+            bitfield_array.set(True, i)
+    return bitfield_array
+
 # New client connection
-def accept(sock, trackerInformation, peer_obj_list):
+def accept(sock, trackerInformation, peer_obj_list, engine=None):
     connection, addr = sock.accept()  
     print('accepted', connection, 'from', addr)
 
+    # The selector engine reads the handshake and drives the connection from its own loop
+    if engine is not None:
+        engine.addConnection(connection, addr)
+        return
+
     #Extrack IP and Port
     ip, port = addr
 
@@ -1235,13 +1656,11 @@ def accept(sock, trackerInformation, peer_obj_list):
     handshake = connection.recv(68)
 
      # Check if the received data is a valid BitTorrent handshake
-    if len(handshake) != 68 or handshake[1:19] != ("BitTorrent protocol".encode('utf-8')):
+    peer_id = checkHandshake(handshake, objects.trackerRequestMsg.infoHash)
+    if peer_id is None:
         print("Invalid handshake data received. Got this instead: ", connection)
+        connection.close()
         return None
-    
-    if (handshake[1+19+8:1+19+28] == objects.trackerRequestMsg.infoHash):
-        # Extract the peer_id from the handshake
-        peer_id = handshake[48:]
 
     # Prepare hash and ID to send back a Handshake
     hash_and_id = (objects.trackerRequestMsg.infoHash,objects.trackerRequestMsg.peerId.encode(trackerInformation.encoding))
@@ -1254,27 +1673,6 @@ def accept(sock, trackerInformation, peer_obj_list):
     # Handshake resp sent
     connection.send(handshake_send)
 
-    # Get a BitArray with length == num of pieces
-    bitfield_array = BitArray(length=len(trackerInformation.pieces))
-
-    # Search for any piece thats completed (where data == None)
-    for i, data in objects.piecesStatus.items():
-        if data == None:
-            bitfield_array.set(True, i)
-    
-    # Get length of the bitfield bitarray in bytes
-
-    message_length = math.ceil(len(bitfield_array)/8)
-
-    # Pack it into 4 bytes
-
-    length_bytes = struct.pack('>I', message_length)
-
-    bitfield_send = (length_bytes + b'\x05' + bitfield_array.tobytes())
-
-    # Complete sending the bitfield message
-    connection.send(bitfield_send)
-    
     # Register the connection as a peer!
     # bitfield indicating that this peer has no pieces (all zeroes)
     bitfield = BitArray(length=len(trackerInformation.pieces))
@@ -1282,35 +1680,19 @@ def accept(sock, trackerInformation, peer_obj_list):
     # Make a new peer, initialize it, and add it to peer_obj_list
     peer = objects.peer()
     peer.peerId = (ip,port,peer_id, bitfield, connection, trackerInformation)
-    peer.run_main_logic()
+    peer.fastExtension = supportsFastExtension(handshake)
+    peer.extensionProtocol = supportsExtensionProtocol(handshake)
+
+    # Complete sending the bitfield message (HAVE ALL/HAVE NONE with the Fast Extension)
+    peer.send_initial_messages(always=True)
+    peerThread = threading.Thread(target=peer.run_main_logic)
+    peerThread.daemon = True
+    peerThread.start()
 
     peer_obj_list.append(peer)
     # connection.setblocking(False)
 
 
-# Use this method to only recv the correct amount for a message
-def get_message_from_sock(sock):
-    length_prefix = sock.recv(4)
-    if not length_prefix:
-        if objects.DEBUG_MODE:
-            print(f"didnt receive length prefix for this message from sock: {sock}")
-        return None
-    
-    message_length = struct.unpack(">I", length_prefix)[0]
-    print("\t\t- !!!message_length -", message_length)
-    if message_length == 0:
-        # length 0, id -1, empty bytes (A Stay Alive Message)
-        return (0, -1, b'')
-    
-    # Get message ID and payload
-    message_id = sock.recv(1)
-    # payload = sock.recv(message_length - 1)
-    payload = b''
-    while len(payload) < (message_length - 1):
-        payload += sock.recv(message_length - 1 - len(payload))
-    return (message_length, ord(message_id), payload)
-
-
 def unchoke_algorithm(peer_obj_list):
     count = 0
     while objects.trackerRequestMsg.left > 0:
@@ -1319,8 +1701,8 @@ def unchoke_algorithm(peer_obj_list):
                 alivePeers = [peer for peer in peer_obj_list if peer.isAlive]
                 count += 1
 
-                # Get interested peers
-                interested_peers = [peer for peer in alivePeers if peer.peerInterested]
+                # Get interested peers (a peer snubbing us can only get the optimistic unchoke)
+                interested_peers = [peer for peer in alivePeers if peer.peerInterested and not peer.snubbed]
                 # Get the amount to unchoke (could be less than 3)
                 num_to_unchoke = max(len(interested_peers), 3)
                 download_rates = [get_download_rate(peer) for peer in interested_peers]
@@ -1375,7 +1757,7 @@ def unchoke_algorithm(peer_obj_list):
             time.sleep(10)
             count += 1
 
-def listening_thread(args, trackerInformation, peer_obj_list):
+def listening_thread(args, trackerInformation, peer_obj_list, engine=None):
      # Establishing listening socket that'll be used for identifying peers joining swarm *_after_* us (we're recving handshake msg)
     listenerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -1407,7 +1789,7 @@ def listening_thread(args, trackerInformation, peer_obj_list):
             for key, mask in events:
                 # 'callback' runs the abstracted function set as 'data' parameter when socket was registered
                 callback = key.data
-                callback(key.fileobj, trackerInformation, peer_obj_list)
+                callback(key.fileobj, trackerInformation, peer_obj_list, engine)
     # *** TODO: Find way to get rid of exited client sockets (Working with timeout?) ***
     selector.unregister(trackerSocket)
     selector.close()